@@ -6,137 +6,508 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
 import altair as alt
-import itertools as itr
+import multiprocessing as mp
+from os.path import dirname, isfile
+from altair.vegalite.v3.display import (
+    VEGA_VERSION, VEGALITE_VERSION, VEGAEMBED_VERSION)
 
+from Xphate.results import filter_points
 
-def make_subplot(circ, select, tooltip, dtype):
+GRID_DATA = 'xphate_points'
+VEGA_LIBRARIES = [('vega', VEGA_VERSION), ('vega-lite', VEGALITE_VERSION),
+                  ('vega-embed', VEGAEMBED_VERSION)]
+CELLS_DATA = 'xphate_cells'
+VNE_DATA = 'xphate_vne'
+N_CELLS = 50
+
+# the chart template of the --separate figures, for the pool workers
+FIGURE = {}
+
+FIGURE_HTML = """<!DOCTYPE html>
+<html>
+<head>
+%(libraries)s
+  <script type="text/javascript">var XPHATE_DATA = {};</script>
+%(scripts)s
+</head>
+<body>
+  <div id="vis"></div>
+  <script>
+    var spec = %(spec)s;
+    var grid = %(grid)s;
+    var named = %(named)s;
+    var cache = {};
+    function getRows(name) {
+      // the columns of a dataset back to the rows vega-lite reads
+      if (!(name in cache)) {
+        var cols = XPHATE_DATA[name], keys = Object.keys(cols);
+        var n = keys.length ? cols[keys[0]].length : 0, rows = new Array(n);
+        for (var i = 0; i < n; i++) {
+          var row = {};
+          for (var k = 0; k < keys.length; k++) row[keys[k]] = cols[keys[k]][i];
+          rows[i] = row;
+        }
+        cache[name] = rows;
+      }
+      return cache[name];
+    }
+    spec.datasets = {};
+    %(datasets)s.forEach(function(name) { spec.datasets[name] = getRows(name); });
+    var current = {};
+    Object.keys(named).forEach(function(data) {
+      current[data] = named[data];
+      spec.datasets[data] = current[data] ? getRows(current[data]) : [];
+    });
+    vegaEmbed("#vis", spec, {"mode": "vega-lite"}).then(function(result) {
+      if (!grid) return;
+      var view = result.view;
+      // each knn/decay/t point is its own dataset: the sliders swap it in
+      function swap() {
+        var key = grid.signals.map(function(x) { return view.signal(x); });
+        Object.keys(grid.points).forEach(function(data) {
+          // no dataset for this point: an empty chart, not the last one
+          var name = grid.points[data][key.join(',')] || null;
+          if (name === current[data]) return;
+          current[data] = name;
+          view.change(data, vega.changeset().remove(vega.truthy).insert(
+            name ? getRows(name) : []));
+        });
+        view.run();
+      }
+      grid.signals.forEach(function(x) { view.addSignalListener(x, swap); });
+    }).catch(console.error);
+  </script>
+</body>
+</html>
+"""
+
+
+def get_rotation():
+    # sliders turning the 3D embedding around its vertical and horizontal
+    # axes (not changed by clicking on the samples)
+    azimuth = alt.selection_single(
+        name='azimuth', fields=['angle'], on='click[false]',
+        bind=alt.binding_range(min=-180, max=180, step=5, name='azimuth:'),
+        init={'angle': 30})
+    elevation = alt.selection_single(
+        name='elevation', fields=['angle'], on='click[false]',
+        bind=alt.binding_range(min=-90, max=90, step=5, name='elevation:'),
+        init={'angle': 20})
+    return [azimuth, elevation]
+
+
+def make_3d_chart(full_pds, source):
+    # orthographic projection of the 3D embedding, rotated in the browser
+    azimuth = 'azimuth.angle * PI / 180'
+    elevation = 'elevation.angle * PI / 180'
+    radius = np.sqrt((full_pds[
+        ['PHATE3D_1', 'PHATE3D_2', 'PHATE3D_3']] ** 2).sum(1)).max()
+    circ_3d = alt.Chart(source).mark_point(size=20).transform_calculate(
+        x_3d='datum.PHATE3D_1 * cos(%s) + datum.PHATE3D_3 * sin(%s)' % (
+            azimuth, azimuth),
+        z_3d='datum.PHATE3D_3 * cos(%s) - datum.PHATE3D_1 * sin(%s)' % (
+            azimuth, azimuth)
+    ).transform_calculate(
+        y_3d='datum.PHATE3D_2 * cos(%s) - datum.z_3d * sin(%s)' % (
+            elevation, elevation),
+        depth='datum.PHATE3D_2 * sin(%s) + datum.z_3d * cos(%s)' % (
+            elevation, elevation)
+    ).encode(
+        x=alt.X('x_3d:Q', title='PHATE 3D',
+                scale=alt.Scale(domain=[-radius, radius])),
+        y=alt.Y('y_3d:Q', title='PHATE 3D',
+                scale=alt.Scale(domain=[-radius, radius])),
+        opacity=alt.Opacity('depth:Q', legend=None,
+                            scale=alt.Scale(range=[0.2, 1])),
+        order='depth:Q'
+    )
+    return circ_3d
+
+
+def get_field(variable: str) -> str:
+    # dots and brackets would be read as nested fields by vega-lite
+    for char in ['.', '[', ']']:
+        variable = variable.replace(char, '\\%s' % char)
+    return variable
+
+
+def get_variables(full_pds, meta_pds) -> tuple:
+    cats = [x for x in full_pds.columns if 'cluster_k' in x]
+    nums = []
+    for col in meta_pds.columns:
+        if col == 'sample_name':
+            continue
+        if str(meta_pds[col].dtype) == 'object':
+            cats.append(col)
+        else:
+            nums.append(col)
+    return cats, nums
+
+
+def fold_variables(chart, meta_pds, variables):
+    # the per-sample metadata is joined to the embedding of the selected
+    # knn/decay/t point, and only then stacked into variable/factor rows
+    meta_vars = [x for x in variables if x in meta_pds.columns]
+    if meta_vars:
+        chart = chart.transform_lookup(
+            lookup='sample_name',
+            from_=alt.LookupData(
+                data=meta_pds, key='sample_name',
+                fields=[get_field(x) for x in meta_vars]),
+            default='NA'
+        )
+    return chart.transform_fold(
+        [get_field(x) for x in variables], as_=['variable', 'factor'])
+
+
+def get_cells(full_pds, meta_pds, variables: list, agg: str,
+              dims: list):
+    # the numerical variables aggregated in a grid of cells over the
+    # embedding of each knn/decay/t point (of the sliders dimensions)
+    pds = full_pds[dims + ['sample_name', 'PHATE1', 'PHATE2']].merge(
+        meta_pds[['sample_name'] + variables], on='sample_name', how='left')
+    if dims:
+        point = pds.groupby(dims).ngroup().values
+    else:
+        point = np.zeros(pds.shape[0], dtype=int)
+    n_points = point.max() + 1
+    bins, starts, widths = [], [], []
+    for axis in ['PHATE1', 'PHATE2']:
+        coords = pds[axis].values
+        lo = np.full(n_points, np.inf)
+        hi = np.full(n_points, -np.inf)
+        np.minimum.at(lo, point, coords)
+        np.maximum.at(hi, point, coords)
+        width = np.where(hi > lo, hi - lo, 1) / N_CELLS
+        bins.append(np.clip(((coords - lo[point]) / width[point]).astype(int),
+                            0, N_CELLS - 1))
+        starts.append(lo)
+        widths.append(width)
+    cell = (point * N_CELLS + bins[0]) * N_CELLS + bins[1]
+
+    cells = []
+    for variable in variables:
+        values = pd.to_numeric(pds[variable], errors='coerce').values
+        valid = ~np.isnan(values)
+        keys, inverse, counts = np.unique(
+            cell[valid], return_inverse=True, return_counts=True)
+        values = values[valid]
+        if agg == 'count':
+            factor = counts
+        elif agg == 'mean':
+            factor = np.bincount(inverse, weights=values) / counts
+        else:
+            # middle value(s) of each cell, once sorted by cell and value
+            values = values[np.lexsort((values, inverse))]
+            first = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            factor = (values[first + (counts - 1) // 2] +
+                      values[first + counts // 2]) / 2
+        cell_point, cell_xy = np.divmod(keys, N_CELLS * N_CELLS)
+        cell_x, cell_y = np.divmod(cell_xy, N_CELLS)
+        x = starts[0][cell_point] + cell_x * widths[0][cell_point]
+        y = starts[1][cell_point] + cell_y * widths[1][cell_point]
+        cells.append(pd.DataFrame({
+            'point': cell_point, 'x': x, 'x2': x + widths[0][cell_point],
+            'y': y, 'y2': y + widths[1][cell_point], 'variable': variable,
+            'factor': factor, 'n': counts}))
+    cells = pd.concat(cells)
+    if dims:
+        points = pds[dims].groupby(point).first()
+        cells = cells.join(points, on='point')
+    return cells.drop(columns='point')
+
+
+def make_cells_chart(source, agg: str):
+    return alt.Chart(source).mark_rect().encode(
+        x=alt.X('x:Q', title='PHATE1'),
+        x2='x2:Q',
+        y=alt.Y('y:Q', title='PHATE2'),
+        y2='y2:Q',
+        color=alt.Color('factor:Q', title=agg),
+        tooltip=['variable:N', alt.Tooltip('factor:Q', title=agg), 'n:Q']
+    )
+
+
+def make_subplot(circ, select, tooltip, dtype, variables, meta_pds,
+                 circ_3d=None, rotation=(), cells=None):
     if dtype == 'N':
         title = 'Categorical variables'
     elif dtype == 'Q':
         title = 'Numerical variables'
-    tooltip.extend(['variable', 'factor'])
-    circ_dtype = circ.encode(
-        color='factor:%s' % dtype,
-        tooltip=tooltip
-    ).add_selection(
+    tooltip.extend(['variable:N', 'factor:%s' % dtype])
+    if cells is None:
+        circ_dtype = fold_variables(
+            circ, meta_pds, variables
+        ).encode(
+            color='factor:%s' % dtype,
+            tooltip=tooltip
+        )
+    else:
+        # the cells of the aggregated view, already by variable
+        circ_dtype = cells
+    circ_dtype = circ_dtype.add_selection(
         select
     ).transform_filter(
         select
     ).properties(
         title=title
     )
+    if circ_3d is not None:
+        circ_dtype = alt.vconcat(circ_dtype, fold_variables(
+            circ_3d, meta_pds, variables
+        ).add_selection(
+            *rotation
+        ).encode(
+            color='factor:%s' % dtype,
+            tooltip=tooltip
+        ).transform_filter(
+            select
+        ).properties(
+            title='%s (3D)' % title
+        ))
     return circ_dtype
 
 
-def selectors_figure(text, o_html, full_pds, ts, ts_step,
-                     decays, decays_step, knns, knns_step):
+def get_lod_samples(full_pds, meta_pds, max_points: int) -> list:
+    # the same samples for every knn/decay/t point: every category of each
+    # categorical metadata column (or else every cell of the embedding of the
+    # first point) gets one sample, then the budget is filled at random,
+    # with the densest cells thinned out
+    samples = full_pds['sample_name'].unique()
+    cats = [x for x in meta_pds.columns if x != 'sample_name'
+            and str(meta_pds[x].dtype) == 'object']
+    if cats:
+        strata = meta_pds.set_index('sample_name')[cats].reindex(
+            samples).fillna('NA')
+        groups = [group for cat in cats
+                  for group in strata.groupby(cat).indices.values()]
+        weights = np.ones(len(samples))
+    else:
+        first = full_pds.drop_duplicates('sample_name').set_index(
+            'sample_name').loc[samples]
+        n_bins = max(1, int(np.sqrt(max_points)))
+        strata = pd.DataFrame({x: pd.cut(first[x], n_bins, labels=False)
+                               for x in ['PHATE1', 'PHATE2']})
+        groups = list(strata.groupby(['PHATE1', 'PHATE2']).indices.values())
+        weights = np.ones(len(samples))
+        for group in groups:
+            weights[group] = 1 / np.sqrt(len(group))
+    rng = np.random.RandomState(0)
+    kept = np.unique([rng.choice(group) for group in groups])
+    # more categories than points: not all of them can be shown
+    rng.shuffle(kept)
+    kept = kept[:max_points]
+    rest = np.setdiff1d(np.arange(len(samples)), kept)
+    n_rest = min(max_points - len(kept), len(rest))
+    if n_rest > 0:
+        kept = np.concatenate([kept, rng.choice(
+            rest, n_rest, replace=False, p=weights[rest] / weights[rest].sum())])
+    if len(kept) > max_points:
+        raise ValueError('%s samples kept for %s points' % (
+            len(kept), max_points))
+    return samples[np.sort(kept)].tolist()
 
-    subtext = ['Parameters:']
-    tooltip = ['sample_name', 'PHATE1', 'PHATE2']
 
-    circ = alt.Chart(full_pds).mark_point(size=20).encode(
-        x='PHATE1:Q',
-        y='PHATE2:Q'
+def get_values(pds) -> tuple:
+    # the rows of a dataset and its name from their content, as in altair
+    values = alt.utils.data.to_values(pds)['values']
+    name = 'data-%s' % hashlib.md5(json.dumps(
+        values, sort_keys=True).encode()).hexdigest()
+    return name, values
+
+
+def get_columns(values: list) -> str:
+    keys = list(values[0]) if values else []
+    return json.dumps({key: [row.get(key) for row in values] for key in keys},
+                      separators=(',', ':'))
+
+
+def write_sidecars(datasets: dict, o_dir: str) -> list:
+    # one script per dataset, by columns, loaded with a <script> tag so that
+    # the page also opens from a local directory; the datasets are named by
+    # their content hash and shared by the pages of the same folder
+    os.makedirs('%s/xphate_data' % o_dir, exist_ok=True)
+    srcs = []
+    for name, values in datasets.items():
+        src = 'xphate_data/%s.js' % name
+        if not isfile('%s/%s' % (o_dir, src)):
+            tmp = '%s/%s.%s.tmp' % (o_dir, src, os.getpid())
+            with open(tmp, 'w') as o:
+                o.write('XPHATE_DATA[%s] = %s;\n' % (
+                    json.dumps(name), get_columns(values)))
+            os.replace(tmp, '%s/%s' % (o_dir, src))
+        srcs.append(src)
+    return srcs
+
+
+def get_libraries(vega_dir: str, html_data: str, o_dir: str) -> str:
+    # the vega libraries from the CDN, or from local copies (next to the
+    # sidecar data, or else in the page) for the page to render offline
+    scripts = []
+    for lib, version in VEGA_LIBRARIES:
+        if not vega_dir:
+            scripts.append(
+                '  <script type="text/javascript" '
+                'src="https://cdn.jsdelivr.net/npm/%s@%s"></script>' % (
+                    lib, version))
+            continue
+        paths = [x for x in ['%s/%s.min.js' % (vega_dir, lib),
+                             '%s/%s.js' % (vega_dir, lib)] if isfile(x)]
+        if not paths:
+            raise IOError('No %s.min.js or %s.js in "%s"' % (
+                lib, lib, vega_dir))
+        if html_data == 'sidecar':
+            os.makedirs('%s/xphate_data' % o_dir, exist_ok=True)
+            src = 'xphate_data/%s.js' % lib
+            shutil.copyfile(paths[0], '%s/%s' % (o_dir, src))
+            scripts.append(
+                '  <script type="text/javascript" src="%s"></script>' % src)
+        else:
+            with open(paths[0]) as f:
+                scripts.append('  <script type="text/javascript">%s</script>' % (
+                    f.read().replace('</script', '<\\/script')))
+    return '\n'.join(scripts)
+
+
+def get_grid(grids: dict, dims: list, inits: list) -> tuple:
+    # one dataset per slider position, and the index from the sliders
+    # values (the signals of the bound selections) to the dataset names
+    datasets, points, named = {}, {}, {}
+    for data, pds in grids.items():
+        points[data], named[data] = {}, None
+        for values, sub_pds in pds.groupby(dims):
+            if not isinstance(values, tuple):
+                values = (values,)
+            name, datasets[name] = get_values(sub_pds)
+            points[data][','.join(map(str, values))] = name
+            if list(values) == list(inits):
+                named[data] = name
+    grid = {'points': points,
+            'signals': ['%s_%s' % (dim, dim) for dim in dims]}
+    return datasets, grid, named
+
+
+def get_spec(circ) -> tuple:
+    # the data is not given to altair for the knn/decay/t points datasets
+    with alt.data_transformers.disable_max_rows():
+        spec = circ.to_dict()
+    datasets = spec.pop('datasets', {})
+    return json.dumps(spec), datasets
+
+
+def write_figure(o_html, spec: str, datasets: dict, html_data: str,
+                 libraries: str, named: dict = None, grid: dict = None):
+    # `named`: the dataset (at first) of the named data of the charts
+    named = named or {}
+    swapped = set(named.values())
+    if grid:
+        swapped.update(x for points in grid['points'].values()
+                       for x in points.values())
+    if html_data == 'sidecar':
+        scripts = [
+            '  <script type="text/javascript" src="%s"></script>' % x
+            for x in write_sidecars(datasets, dirname(o_html))]
+    else:
+        scripts = [
+            '  <script type="text/javascript">XPHATE_DATA[%s] = %s;</script>' % (
+                json.dumps(name), get_columns(values))
+            for name, values in datasets.items()]
+    spec_datasets = [x for x in datasets if x not in swapped]
+    with open(o_html, 'w') as o:
+        o.write(FIGURE_HTML % {
+            'libraries': libraries, 'spec': spec,
+            'grid': json.dumps(grid), 'named': json.dumps(named),
+            'datasets': json.dumps(spec_datasets),
+            'scripts': '\n'.join(scripts)})
+
+
+def save_figure(circ, o_html, html_data, libraries, grids=None, dims=(),
+                inits=()):
+    spec, datasets = get_spec(circ)
+    grid, named = None, {}
+    if grids:
+        grid_datasets, grid, named = get_grid(grids, dims, inits)
+        datasets.update(grid_datasets)
+    write_figure(o_html, spec, datasets, html_data, libraries, named, grid)
+    print('-> Written:', o_html)
+
+
+def get_vne_pds(vne_pds):
+    vne_pds = vne_pds.copy()
+    vne_pds['knn_decay'] = [
+        'knn=%s, decay=%s' % (knn, decay) for knn, decay in zip(
+            vne_pds['knn'], vne_pds['decay'])]
+    return vne_pds
+
+
+def vne_figure(source):
+    vne = alt.Chart(source).encode(
+        x='t:Q',
+        y='entropy:Q',
+        color='knn_decay:N',
+        tooltip=['knn:Q', 'decay:Q', 't:Q', 'entropy:Q', 'optimal_t:Q']
     )
+    vne_lines = vne.mark_line()
+    vne_knees = vne.transform_filter(
+        'datum.t == datum.optimal_t'
+    ).mark_point(size=60, filled=True)
+    return (vne_lines + vne_knees).properties(
+        title='Von Neumann entropy (automatic t at the knee point)')
 
-    if knns_step:
-        slider_knns = alt.binding_range(
-            min=min(knns),
-            max=max(knns),
-            step=knns_step,
-            name='knn'
-        )
-        selector_knns = alt.selection_single(
-            name="knn",
-            fields=['knn'],
-            bind=slider_knns,
-            init={'knn': min(knns)}
-        )
-        tooltip.append('knn')
-        circ = circ.add_selection(
-            selector_knns
-        ).transform_filter(
-            selector_knns
-        )
-        subtext.append('knn ("k") = %s\n' % ', '.join(map(str, knns)))
-
-    if decays_step:
-        slider_decays = alt.binding_range(
-            min=min(decays),
-            max=max(decays),
-            step=decays_step,
-            name='decay'
-        )
-        selector_decays = alt.selection_single(
-            name="decay",
-            fields=['decay'],
-            bind=slider_decays,
-            init={'decay': min(decays)}
-        )
-        tooltip.append('decay')
-        circ = circ.add_selection(
-            selector_decays
-        ).transform_filter(
-            selector_decays
-        )
-        subtext.append('decay ("alpha") = %s\n' % ', '.join(map(str, decays)))
-
-    if ts_step:
-        slider_ts = alt.binding_range(
-            min=min(ts), max=max(ts), step=ts_step, name='t:')
-        selector_ts = alt.selection_single(
-            name="t", fields=['t'], bind=slider_ts, init={'t': min(ts)})
-        tooltip.append('t')
-        circ = circ.add_selection(
-            selector_ts
-        ).transform_filter(
-            selector_ts
-        )
-        subtext.append('t = %s\n' % ', '.join(map(str, ts)))
+
+def make_chart(circ, tooltip, full_pds, meta_pds, source, num_agg='none',
+               cells_source=None, selectors=(), vne_source=None,
+               text=()) -> tuple:
+    # the variables, 3D, cells and VNE charts around the points chart, for
+    # both the sliders figure and the template of the --separate figures
+    circ_3d, rotation = None, []
+    if 'PHATE3D_1' in full_pds.columns:
+        circ_3d, rotation = make_3d_chart(full_pds, source), get_rotation()
 
     has_cats = 0
     has_nums = 0
-    if 'variable' in full_pds.columns:
-
-        dtypes_set = set(full_pds['dtype'])
-        if 'categorical' in dtypes_set:
-            cats = full_pds.loc[full_pds.dtype == 'categorical']
-            cats_init = sorted([
-                x for x in cats['variable'] if str(x) != 'nan'],
-                key=lambda x: -len(x))[0]
-            cats_dropdown = alt.binding_select(
-                options=cats['variable'].unique(), name='variable:')
-            cats_select = alt.selection_single(
-                fields=['variable'], bind=cats_dropdown,
-                name="categorical variable", init={'variable': cats_init})
-            cats_plot = make_subplot(
-                circ, cats_select, list(tooltip), 'N')
-            has_cats = 1
-
-        if 'numerical' in dtypes_set:
-            nums = full_pds.loc[full_pds.dtype == 'numerical']
-            cats_init = sorted([
-                x for x in nums['variable'] if str(x) != 'nan'],
-                key=lambda x: -len(x))[0]
-            nums_dropdown = alt.binding_select(
-                options=nums['variable'].unique(), name='variable:')
-            nums_select = alt.selection_single(
-                fields=['variable'], bind=nums_dropdown,
-                name="numerical variable", init={'variable': cats_init})
-            nums_plot = make_subplot(
-                circ, nums_select, list(tooltip), 'Q')
-            has_nums = 1
-
-    title = {
-        "text": text,
-        "color": "black",
-    }
-    if subtext != ['Parameters:']:
-        title.update({
-            "subtitle": (subtext + ["(based on altair)"]),
-            "subtitleColor": "grey"
-        })
+    cells = None
+    cats_vars, nums_vars = get_variables(full_pds, meta_pds)
+    if cats_vars:
+        cats_init = sorted(cats_vars, key=lambda x: -len(x))[0]
+        cats_dropdown = alt.binding_select(
+            options=sorted(cats_vars), name='variable:')
+        cats_select = alt.selection_single(
+            fields=['variable'], bind=cats_dropdown,
+            name="categorical variable", init={'variable': cats_init})
+        cats_plot = make_subplot(
+            circ, cats_select, list(tooltip), 'N', cats_vars, meta_pds,
+            circ_3d, rotation)
+        # the rotation sliders are only added to one of the 3D views
+        rotation = []
+        has_cats = 1
+
+    if nums_vars:
+        nums_init = sorted(nums_vars, key=lambda x: -len(x))[0]
+        nums_dropdown = alt.binding_select(
+            options=sorted(nums_vars), name='variable:')
+        nums_select = alt.selection_single(
+            fields=['variable'], bind=nums_dropdown,
+            name="numerical variable", init={'variable': nums_init})
+        if num_agg != 'none':
+            if cells_source is None:
+                cells_source = get_cells(
+                    full_pds, meta_pds, nums_vars, num_agg, [])
+            cells = make_cells_chart(cells_source, num_agg)
+            if selectors and not has_cats:
+                # the sliders are otherwise only on the points charts
+                cells = cells.add_selection(*selectors)
+        nums_plot = make_subplot(
+            circ, nums_select, list(tooltip), 'Q', nums_vars, meta_pds,
+            circ_3d, rotation, cells)
+        has_nums = 1
 
     if has_nums and has_cats:
         circ = alt.hconcat(cats_plot, nums_plot)
@@ -144,78 +515,143 @@ def selectors_figure(text, o_html, full_pds, ts, ts_step,
         circ = nums_plot
     elif has_cats:
         circ = cats_plot
+    elif circ_3d is not None:
+        circ = alt.vconcat(circ, circ_3d.add_selection(*rotation))
 
-    circ.save(o_html)
-    print('-> Written:', o_html)
+    if vne_source is not None:
+        circ = alt.vconcat(circ, vne_figure(vne_source))
+
+    if text:
+        circ = circ.properties(title=alt.TitleParams(
+            ' - '.join(text), anchor='start'))
+
+    # the datasets of each knn/decay/t point
+    named = []
+    if has_cats or circ_3d is not None or cells is None:
+        named.append(GRID_DATA)
+    if cells is not None:
+        named.append(CELLS_DATA)
+    return circ, named, nums_vars
 
 
-def single_figure(text, o_html, full_pds):
+def selectors_figure(text, o_html, full_pds, meta_pds, vne_pds, ts, ts_step,
+                     decays, decays_step, knns, knns_step, html_data,
+                     libraries, num_agg='none'):
 
-    subtext = ['Parameters:']
-    tooltip = ['sample_name', 'PHATE1', 'PHATE2']
+    tooltip = ['sample_name:N', 'PHATE1:Q', 'PHATE2:Q']
+    dims, inits, selectors = [], [], []
 
-    circ = alt.Chart(full_pds).mark_point(size=20).encode(
+    # the embedding of each slider position is a dataset of its own, swapped
+    # in by the html when a slider moves (see save_figure)
+    sliders = [('knn', knns, knns_step, 'knn'),
+               ('decay', decays, decays_step, 'decay'),
+               ('t', ts, ts_step, 't:')]
+    if [x for x in sliders if x[2]]:
+        source = alt.NamedData(name=GRID_DATA)
+    else:
+        source = full_pds
+
+    circ = alt.Chart(source).mark_point(size=20).encode(
         x='PHATE1:Q',
         y='PHATE2:Q'
     )
 
-    has_cats = 0
-    has_nums = 0
-    if 'variable' in full_pds.columns:
-        dtypes_set = set(full_pds['dtype'])
-        if 'categorical' in dtypes_set:
-            cats = full_pds.loc[full_pds.dtype == 'categorical']
-            cats_init = sorted([
-                x for x in cats['variable'] if str(x) != 'nan'],
-                key=lambda x: -len(x))[0]
-            cats_dropdown = alt.binding_select(
-                options=sorted(cats['variable'].unique()), name='variable:')
-            cats_select = alt.selection_single(
-                fields=['variable'], bind=cats_dropdown,
-                name="categorical variable", init={'variable': cats_init})
-            cats_plot = make_subplot(
-                circ, cats_select, list(tooltip), 'N')
-            has_cats = 1
-
-        if 'numerical' in dtypes_set:
-            nums = full_pds.loc[full_pds.dtype == 'numerical']
-            cats_init = sorted([
-                x for x in nums['variable'] if str(x) != 'nan'],
-                key=lambda x: -len(x))[0]
-            nums_dropdown = alt.binding_select(
-                options=sorted(nums['variable'].unique()), name='variable:')
-            nums_select = alt.selection_single(
-                fields=['variable'], bind=nums_dropdown,
-                name="numerical variable", init={'variable': cats_init})
-            nums_plot = make_subplot(
-                circ, nums_select, list(tooltip), 'Q')
-            has_nums = 1
-
-    title = {
-        "text": text,
-        "color": "black",
-    }
-    if subtext != ['Parameters:']:
-        title.update({
-            "subtitle": (subtext + ["(based on altair)"]),
-            "subtitleColor": "grey"
-        })
+    for (dim, values, step, name) in sliders:
+        if not step:
+            continue
+        slider = alt.binding_range(
+            min=min(values),
+            max=max(values),
+            step=step,
+            name=name
+        )
+        selector = alt.selection_single(
+            name=dim,
+            fields=[dim],
+            bind=slider,
+            on='click[false]',
+            init={dim: min(values)}
+        )
+        tooltip.append('%s:Q' % dim)
+        circ = circ.add_selection(
+            selector
+        )
+        selectors.append(selector)
+        dims.append(dim)
+        inits.append(min(values))
 
-    if has_nums and has_cats:
-        circ = alt.hconcat(cats_plot, nums_plot)
-    elif has_nums:
-        circ = nums_plot
-    elif has_cats:
-        circ = cats_plot
+    vne_source = None
+    if vne_pds.shape[0]:
+        vne_source = get_vne_pds(vne_pds)
+    circ, named, nums_vars = make_chart(
+        circ, tooltip, full_pds, meta_pds, source, num_agg,
+        (alt.NamedData(name=CELLS_DATA) if dims else None), selectors,
+        vne_source, text)
 
-    circ.save(o_html)
-    print('-> Written:', o_html)
+    grids = {}
+    if dims and GRID_DATA in named:
+        grids[GRID_DATA] = full_pds
+    if dims and CELLS_DATA in named:
+        grids[CELLS_DATA] = get_cells(
+            full_pds, meta_pds, nums_vars, num_agg, dims)
+    save_figure(circ, o_html, html_data, libraries, grids, dims, inits)
+
+
+def single_chart(text, full_pds, meta_pds, vne_pds,
+                 num_agg='none') -> tuple:
+    # the chart of the --separate figures, built once on named data for
+    # all the knn/decay/t points (`full_pds` only for the variables and
+    # the 3D domain)
+    source = alt.NamedData(name=GRID_DATA)
+    circ = alt.Chart(source).mark_point(size=20).encode(
+        x='PHATE1:Q',
+        y='PHATE2:Q'
+    )
+    vne_source = None
+    if vne_pds.shape[0]:
+        vne_source = alt.NamedData(name=VNE_DATA)
+    circ, named, nums_vars = make_chart(
+        circ, ['sample_name:N', 'PHATE1:Q', 'PHATE2:Q'], full_pds, meta_pds,
+        source, num_agg, alt.NamedData(name=CELLS_DATA), (), vne_source, text)
+    if vne_source is not None:
+        named.append(VNE_DATA)
+    return circ, named, nums_vars
 
 
-def make_figure(i_table, i_res, o_html, full_pds, ts, ts_step,
-                decays, decays_step, knns, knns_step, clusters, separate):
+def init_figure(spec: str, datasets: dict, named: list, nums_vars: list,
+                meta_pds, html_data: str, libraries: str,
+                num_agg: str) -> None:
+    FIGURE.update({'spec': spec, 'datasets': datasets, 'named': named,
+                   'nums_vars': nums_vars, 'meta_pds': meta_pds,
+                   'html_data': html_data, 'libraries': libraries,
+                   'num_agg': num_agg})
+
+
+def single_figure(task: tuple) -> str:
+    # one knn/decay/t point in the template chart
+    o_html, full_pds, vne_pds = task
+    parts = {GRID_DATA: full_pds}
+    if CELLS_DATA in FIGURE['named']:
+        parts[CELLS_DATA] = get_cells(
+            full_pds, FIGURE['meta_pds'], FIGURE['nums_vars'],
+            FIGURE['num_agg'], [])
+    if VNE_DATA in FIGURE['named']:
+        parts[VNE_DATA] = get_vne_pds(vne_pds)
+    datasets, named = dict(FIGURE['datasets']), {}
+    for data in FIGURE['named']:
+        named[data], datasets[named[data]] = get_values(parts[data])
+    write_figure(o_html, FIGURE['spec'], datasets, FIGURE['html_data'],
+                 FIGURE['libraries'], named)
+    return o_html
+
+
+def make_figure(i_table, i_res, o_html, full_pds, meta_pds, vne_pds, ts,
+                ts_step, decays, decays_step, knns, knns_step, clusters,
+                separate, html_data='inline', max_points=0, num_agg='none',
+                n_jobs=1, vega_dir=None):
     if not clusters:
-        full_pds = full_pds.loc[~full_pds.variable.str.contains('cluster_k')]
+        full_pds = full_pds.drop(
+            columns=[x for x in full_pds.columns if 'cluster_k' in x])
 
     text = []
     if i_table:
@@ -223,26 +659,66 @@ def make_figure(i_table, i_res, o_html, full_pds, ts, ts_step,
     elif i_res:
         text.append('PHATE for pre-computed table "%s"' % i_res)
 
+    n_samples = full_pds['sample_name'].nunique()
+    if max_points and n_samples > max_points:
+        # level of detail: at most about `max_points` points per chart
+        samples = get_lod_samples(full_pds, meta_pds, max_points)
+        full_pds = full_pds.loc[full_pds['sample_name'].isin(samples)]
+        if meta_pds.shape[0]:
+            meta_pds = meta_pds.loc[meta_pds['sample_name'].isin(samples)]
+        text.append('subsample of %s samples out of %s (%.1f%%)' % (
+            len(samples), n_samples, 100 * len(samples) / n_samples))
+
+    libraries = get_libraries(vega_dir, html_data, dirname(o_html))
     if separate:
-        iterator = []
-        if ts != [None]:
-            ts_ = range(min(ts), (max(ts) + 1), ts_step)
-            iterator.append([('t', x) for x in ts_])
-        if knns != [None]:
-            knns_ = range(min(knns), (max(knns) + 1), knns_step)
-            iterator.append([('knn', x) for x in knns_])
-        if decays != [None]:
-            decays_ = range(min(decays), (max(decays) + 1), decays_step)
-            iterator.append([('decay', x) for x in decays_])
-        for its in itr.product(*iterator):
+        # one page per requested point, whatever else the results hold
+        full_pds = filter_points(full_pds, knns, decays, ts)
+        # (the t of the entropy curve is not a grid coordinate)
+        vne_pds = filter_points(vne_pds, knns, decays, [None])
+        # the points partitioned once, rendered in one chart template
+        circ, named, nums_vars = single_chart(
+            text, full_pds, meta_pds, vne_pds, num_agg)
+        spec, datasets = get_spec(circ)
+        if html_data == 'sidecar':
+            # the datasets shared by all the pages are written only once
+            write_sidecars(datasets, dirname(o_html))
+        dims = [x for x, values in [('t', ts), ('knn', knns), ('decay', decays)]
+                if values != [None]]
+        vne_dims = [x for x in dims if x != 't' and x in vne_pds.columns]
+        vne_parts = {}
+        if vne_dims:
+            for values, vne_part in vne_pds.groupby(vne_dims):
+                if not isinstance(values, tuple):
+                    values = (values,)
+                vne_parts[values] = vne_part
+        tasks = []
+        for values, cur_full_pds in (
+                full_pds.groupby(dims) if dims else [((), full_pds)]):
+            if not isinstance(values, tuple):
+                values = (values,)
+            its = list(zip(dims, values))
             suffix = '-'.join(['%s%s' % (x[0], x[1]) for x in its])
             cur_o_html = o_html.replace('.html', '_%s.html' % suffix)
-            cur_full_pds = full_pds.copy()
-            for (k, v) in its:
-                cur_full_pds = cur_full_pds.loc[full_pds[k] == v]
-            single_figure(text, cur_o_html, cur_full_pds)
+            cur_vne_pds = vne_pds
+            if vne_dims:
+                cur_vne_pds = vne_parts.get(tuple(
+                    v for k, v in its if k in vne_dims), vne_pds.iloc[:0])
+            tasks.append((cur_o_html, cur_full_pds, cur_vne_pds))
+        initargs = (spec, datasets, named, nums_vars, meta_pds, html_data,
+                    libraries, num_agg)
+        n_procs = min(max(n_jobs, 1), len(tasks))
+        if n_procs > 1:
+            with mp.Pool(n_procs, initializer=init_figure,
+                         initargs=initargs) as pool:
+                for cur_o_html in pool.imap_unordered(single_figure, tasks):
+                    print('-> Written:', cur_o_html)
+        else:
+            init_figure(*initargs)
+            for task in tasks:
+                print('-> Written:', single_figure(task))
     else:
-        selectors_figure(text, o_html, full_pds, ts, ts_step, decays,
-                         decays_step, knns, knns_step)
+        selectors_figure(text, o_html, full_pds, meta_pds, vne_pds, ts,
+                         ts_step, decays, decays_step, knns, knns_step,
+                         html_data, libraries, num_agg)
 
 
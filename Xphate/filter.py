@@ -6,58 +6,144 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import re
+import operator
+import numpy as np
 import pandas as pd
-from os.path import isfile
+from scipy import sparse
 
+from Xphate.tables import (
+    get_sparse_matrix, get_table_chunks, read_biom, read_table)
 
-def num_filter(otu: pd.DataFrame,
-               p_filter_prevalence: float,
-               p_filter_abundance: float) -> pd.DataFrame:
+OPERATORS = {
+    '<': operator.lt, '<=': operator.le, '>': operator.gt,
+    '>=': operator.ge, '==': operator.eq, '=': operator.eq, '!=': operator.ne
+}
+EXPR_SPLIT = re.compile(r'([&|()])')
+EXPR_TERM = re.compile(
+    r'^(.+?)\s*(<=|>=|==|!=|<|>|=|\s+not\s+in\s+|\s+in\s+)\s*(.+)$')
+
+
+def get_row_sums(otu_mat: sparse.spmatrix) -> np.ndarray:
+    return np.asarray(otu_mat.sum(1)).ravel()
+
+
+def get_col_sums(otu_mat: sparse.spmatrix) -> np.ndarray:
+    return np.asarray(otu_mat.sum(0)).ravel()
+
+
+def get_row_stats(otu_mat: sparse.spmatrix,
+                  col_sums: np.ndarray,
+                  p_filter_abundance: float) -> tuple:
+    # reads per feature and number of samples in which each feature passes
+    # the abundance, with the sample totals of the whole table (so that this
+    # also works on a chunk of the table's rows)
+    abund = p_filter_abundance
+    row_sums = get_row_sums(otu_mat)
+    otu_percent = otu_mat
+    if abund < 1:
+        otu_percent = otu_mat @ sparse.diags(np.divide(
+            1., col_sums, out=np.zeros_like(col_sums), where=col_sums > 0))
+    row_prevs = get_row_sums(otu_percent > abund)
+    return row_sums, row_prevs
+
+
+def get_rows_filter(row_sums: np.ndarray,
+                    row_prevs: np.ndarray,
+                    n_samples: int,
+                    total: float,
+                    p_filter_prevalence: float,
+                    p_filter_abundance: float,
+                    abund_mode: str = 'sample') -> np.ndarray:
     preval, abund = p_filter_prevalence, p_filter_abundance
-    otu_filt = otu.copy()
     # get the min number of samples based on prevalence percent
     if preval < 1:
-        n_percent = otu.shape[1] * preval
+        n_percent = n_samples * preval
     else:
         n_percent = preval
     # abundance filter in terms of min reads counts
-    otu_percent = otu_filt.copy()
-    otu_percent_sum = otu_filt.sum(1)
+    otu_percent_sum = row_sums
     if abund < 1:
-        otu_percent = otu_filt / otu_filt.sum()
-        otu_percent_sum = otu_filt.sum(1) / otu_filt.sum(1).sum()
-
-    abund_mode = 'sample'
+        otu_percent_sum = row_sums / total
 
     # remove features from feature table that are not present
     # in enough samples with the minimum number/percent of reads in these samples
     if abund_mode == 'sample':
-        otu_filt = otu_filt.loc[(otu_percent > abund).sum(1) > n_percent, :]
+        rows = row_prevs > n_percent
     elif abund_mode == 'dataset':
-        otu_filt = otu_filt.loc[otu_percent_sum > abund, :]
+        rows = otu_percent_sum > abund
     elif abund_mode == 'both':
-        otu_filt = otu_filt.loc[(otu_percent > abund).sum(1) > n_percent, :]
-        fil_pd_percent_sum = otu_filt.sum(1)
+        rows = row_prevs > n_percent
+        # dataset abundance among the features kept at the sample level
+        fil_pd_percent_sum = row_sums[rows]
         if abund < 1:
-            fil_pd_percent_sum = otu_filt.sum(1) / otu_filt.sum(1).sum()
-        otu_filt = otu_filt.loc[fil_pd_percent_sum > abund, :]
+            fil_pd_percent_sum = fil_pd_percent_sum / fil_pd_percent_sum.sum()
+        rows[rows] = fil_pd_percent_sum > abund
     else:
         raise Exception('"%s" mode not recognized' % abund_mode)
-    otu_filt = otu_filt.loc[otu_filt.sum(1) > 0, otu_filt.sum(0) > 0]
-    return otu_filt
+    return rows & (row_sums > 0)
 
 
-def get_metadata(m_metadata: str) -> pd.DataFrame:
-    with open(m_metadata) as f:
-        for line in f:
-            break
-    meta = pd.read_csv(
-        m_metadata, header=0, sep='\t',
-        dtype={line.split('\t')[0]: str}
-    )
-    meta = meta.rename(columns={meta.columns.tolist()[0]: 'sample_name'})
-    meta.columns = [x.replace('\n', '') for x in meta.columns]
-    return meta
+def get_num_filter(otu_mat: sparse.spmatrix,
+                   p_filter_prevalence: float,
+                   p_filter_abundance: float,
+                   abund_mode: str = 'sample') -> tuple:
+    # all the modes from the same row/column statistics
+    col_sums = get_col_sums(otu_mat)
+    row_sums, row_prevs = get_row_stats(otu_mat, col_sums, p_filter_abundance)
+    rows = get_rows_filter(row_sums, row_prevs, otu_mat.shape[1],
+                           col_sums.sum(), p_filter_prevalence,
+                           p_filter_abundance, abund_mode)
+    # samples left with reads in the kept features
+    cols = (otu_mat.T @ rows.astype(float)) > 0
+    return rows, cols
+
+
+def stream_num_filter(i_table: str,
+                      p_filter_prevalence: float,
+                      p_filter_abundance: float,
+                      samples: list = None,
+                      abund_mode: str = 'sample',
+                      chunksize: int = 1000) -> pd.DataFrame:
+    # first pass: only the sample totals are kept
+    col_sums = 0
+    for _, chunk, _ in get_table_chunks(i_table, samples, chunksize):
+        col_sums = col_sums + get_col_sums(chunk)
+    # second pass: only the features that can pass the filter are kept (for
+    # 'both', the dataset abundance depends on all the sample-level ones)
+    chunk_mode = 'sample' if abund_mode == 'both' else abund_mode
+    index, chunks, columns, row_sums, row_prevs = [], [], [], [], []
+    for chunk_index, chunk, columns in get_table_chunks(
+            i_table, samples, chunksize):
+        sums, prevs = get_row_stats(chunk, col_sums, p_filter_abundance)
+        rows = get_rows_filter(sums, prevs, chunk.shape[1], col_sums.sum(),
+                               p_filter_prevalence, p_filter_abundance,
+                               chunk_mode)
+        index.extend([x for x, r in zip(chunk_index, rows) if r])
+        chunks.append(chunk[rows])
+        row_sums.append(sums[rows])
+        row_prevs.append(prevs[rows])
+    otu_mat = sparse.vstack(chunks).tocsr()
+    rows = get_rows_filter(np.concatenate(row_sums), np.concatenate(row_prevs),
+                           otu_mat.shape[1], col_sums.sum(),
+                           p_filter_prevalence, p_filter_abundance, abund_mode)
+    otu_mat = otu_mat[np.flatnonzero(rows)]
+    cols = get_col_sums(otu_mat) > 0
+    otu_mat = otu_mat[:, np.flatnonzero(cols)].tocsc()
+    index = [x for x, r in zip(index, rows) if r]
+    return pd.DataFrame.sparse.from_spmatrix(
+        otu_mat, index=pd.Index(index), columns=columns[cols])
+
+
+def num_filter(otu: pd.DataFrame,
+               p_filter_prevalence: float,
+               p_filter_abundance: float,
+               abund_mode: str = 'sample') -> pd.DataFrame:
+    # work on the sparse values: no dense copy of the table is made
+    rows, cols = get_num_filter(get_sparse_matrix(otu), p_filter_prevalence,
+                                p_filter_abundance, abund_mode)
+    otu_filt = otu.iloc[np.flatnonzero(rows), np.flatnonzero(cols)]
+    return otu_filt
 
 
 def get_sign_val(p_omic_value: str) -> list:
@@ -77,44 +163,129 @@ def get_sign_val(p_omic_value: str) -> list:
 
 
 def get_col_bool_sign(meta_col: pd.Series, signs_vals: list) -> pd.Series:
+    meta_col = meta_col.astype(float)
+    meta_bool = pd.Series(True, index=meta_col.index)
+    for sign, val in signs_vals:
+        if sign not in ['<', '>', '<=', '>=']:
+            raise IOError("Sign %s none of ['<', '>', '<=', '>=']" % sign)
+        meta_bool &= OPERATORS[sign](meta_col, val)
+    return meta_bool
 
-    if signs_vals[0][0] == '<':
-        meta_bool = meta_col.astype(float) < signs_vals[0][1]
-    elif signs_vals[0][0] == '>':
-        meta_bool = meta_col.astype(float) > signs_vals[0][1]
-    elif signs_vals[0][0] == '<=':
-        meta_bool = meta_col.astype(float) <= signs_vals[0][1]
-    elif signs_vals[0][0] == '>=':
-        meta_bool = meta_col.astype(float) >= signs_vals[0][1]
-    else:
-        raise IOError("Sign %s none of ['<', '>', '<=', '>=']" % signs_vals[0][0])
-
-    if len(signs_vals) == 2:
-        if signs_vals[1][0] == '<':
-            meta_bool2 = meta_col.astype(float) < signs_vals[1][1]
-        elif signs_vals[1][0] == '>':
-            meta_bool2 = meta_col.astype(float) > signs_vals[1][1]
-        elif signs_vals[1][0] == '<=':
-            meta_bool2 = meta_col.astype(float) <= signs_vals[1][1]
-        elif signs_vals[1][0] == '>=':
-            meta_bool2 = meta_col.astype(float) >= signs_vals[1][1]
+
+def parse_expr(tokens: list, pos: int = 0) -> tuple:
+    # "|" of "&" of terms or of parenthesised expressions
+    ors = []
+    while True:
+        ands = []
+        while True:
+            if pos < len(tokens) and tokens[pos] == '(':
+                node, pos = parse_expr(tokens, pos + 1)
+                if pos >= len(tokens) or tokens[pos] != ')':
+                    raise IOError('Unbalanced parentheses in filter expression')
+                pos += 1
+            elif pos < len(tokens) and tokens[pos] not in '&|)':
+                term = EXPR_TERM.match(tokens[pos])
+                if not term:
+                    raise IOError('Could not read "%s" in filter expression'
+                                  % tokens[pos])
+                col, op, val = term.groups()
+                if val.startswith('{') and val.endswith('}'):
+                    val = [x.strip().strip('"\'') for x in val[1:-1].split(',')]
+                else:
+                    val = val.strip('"\'')
+                node, pos = ('term', col, ' '.join(op.split()), val), pos + 1
+            else:
+                raise IOError('Incomplete filter expression')
+            ands.append(node)
+            if pos < len(tokens) and tokens[pos] == '&':
+                pos += 1
+            else:
+                break
+        ors.append(('&', ands))
+        if pos < len(tokens) and tokens[pos] == '|':
+            pos += 1
         else:
-            raise IOError("Sign %s none of ['<', '>', '<=', '>=']" % signs_vals[1][0])
-        return meta_bool & meta_bool2
-    else:
-        return meta_bool
+            break
+    return ('|', ors), pos
 
 
-def cat_filter(otu: pd.DataFrame, m_metadata: str,
-               p_column: str, p_column_value: tuple,
-               p_column_quant: int) -> pd.DataFrame:
+def get_expr_tree(p_filter_expr: str) -> tuple:
+    tokens = [x.strip() for x in EXPR_SPLIT.split(p_filter_expr) if x.strip()]
+    tree, pos = parse_expr(tokens)
+    if pos != len(tokens):
+        raise IOError('Could not read filter expression "%s"' % p_filter_expr)
+    return tree
+
+
+def get_expr_columns(tree: tuple) -> list:
+    if tree[0] == 'term':
+        return [tree[1]]
+    return [col for node in tree[1] for col in get_expr_columns(node)]
+
+
+def get_term_mask(metadata: pd.DataFrame, numerics: dict, col: str,
+                  op: str, val) -> pd.Series:
+    if col not in metadata.columns:
+        raise IOError('Variable "%s" not in metadata' % col)
+    # each column is made numeric once for all the terms using it
+    if col not in numerics:
+        numerics[col] = pd.to_numeric(metadata[col], errors='coerce')
+    num_col = numerics[col]
+    if op in ['in', 'not in']:
+        if not isinstance(val, list):
+            val = [val]
+        if pd.api.types.is_numeric_dtype(metadata[col]):
+            mask = num_col.isin(pd.to_numeric(pd.Series(val), errors='coerce'))
+        else:
+            mask = metadata[col].astype(str).isin(val)
+        return ~mask if op == 'not in' else mask
+    if re.match(r'^q\d+(\.\d+)?$', val):
+        # percentile of the column, as for `-q`
+        return OPERATORS[op](num_col, num_col.quantile(float(val[1:]) / 100))
+    try:
+        return OPERATORS[op](num_col, float(val))
+    except ValueError:
+        if op in ['==', '=', '!=']:
+            return OPERATORS[op](metadata[col].astype(str), val)
+        raise IOError('"%s %s %s": must be numeric or a percentile (e.g. q25)'
+                      % (col, op, val))
+
+
+def get_expr_mask(metadata: pd.DataFrame, tree: tuple,
+                  numerics: dict = None) -> pd.Series:
+    # one boolean mask over the metadata for the whole expression
+    if numerics is None:
+        numerics = {}
+    if tree[0] == 'term':
+        return get_term_mask(metadata, numerics, *tree[1:])
+    masks = [get_expr_mask(metadata, node, numerics) for node in tree[1]]
+    mask = masks[0]
+    for other in masks[1:]:
+        mask = (mask & other) if tree[0] == '&' else (mask | other)
+    return mask
+
+
+def has_meta_filter(metadata: pd.DataFrame, p_column: str,
+                    p_column_value: tuple, p_column_quant: int,
+                    p_filter_expr: str) -> bool:
+    if not metadata.shape[0]:
+        return False
+    return bool(p_column and (p_column_value or p_column_quant)
+                or p_filter_expr)
+
 
-    if not isfile(m_metadata):
-        raise IOError('No metadata file named', m_metadata)
-    meta = get_metadata(m_metadata)
+def get_cat_samples(metadata: pd.DataFrame, p_column: str,
+                    p_column_value: tuple, p_column_quant: int,
+                    p_filter_expr: str = None) -> list:
 
-    if p_column not in meta.columns.tolist()[1:]:
-        raise IOError('Variable "%s" not in metadata "%s"' % (p_column, m_metadata))
+    meta = metadata
+    if p_filter_expr:
+        meta = meta[get_expr_mask(meta, get_expr_tree(p_filter_expr))]
+    if not p_column:
+        return meta.index.tolist()
+
+    if p_column not in meta.columns:
+        raise IOError('Variable "%s" not in metadata' % p_column)
     elif p_column.replace('\\n', '') in meta.columns:
         p_column = p_column.replace('\\n', '')
 
@@ -135,31 +306,110 @@ def cat_filter(otu: pd.DataFrame, m_metadata: str,
                 raise IndexError('None of "%s" in column "%s"' % (', '.join(list(p_column_value)), p_column))
             filt = meta_col.isin([x for x in p_column_value])
         meta = meta[filt]
+    return meta.index.tolist()
+
 
-    otu = otu.loc[:, list(set(meta.sample_name) & set(otu.columns))]
+def cat_filter(otu: pd.DataFrame, metadata: pd.DataFrame,
+               p_column: str, p_column_value: tuple,
+               p_column_quant: int, p_filter_expr: str = None) -> pd.DataFrame:
+    samples = get_cat_samples(
+        metadata, p_column, p_column_value, p_column_quant, p_filter_expr)
+    otu = otu.loc[:, list(set(samples) & set(otu.columns))]
     return otu
 
 
 def do_filter(otu: pd.DataFrame,
-              m_metadata: str,
+              metadata: pd.DataFrame,
               p_filter_prevalence: float,
               p_filter_abundance: float,
               p_filter_order: str,
               p_column: str,
               p_column_value: tuple,
-              p_column_quant: int) -> pd.DataFrame:
+              p_column_quant: int,
+              p_filter_mode: str = 'sample',
+              p_filter_expr: str = None) -> pd.DataFrame:
 
     if p_filter_order == 'meta-filter':
-        if m_metadata and p_column:
-            if p_column_value or p_column_quant:
-                otu = cat_filter(otu, m_metadata, p_column, p_column_value, p_column_quant)
+        if has_meta_filter(metadata, p_column, p_column_value,
+                           p_column_quant, p_filter_expr):
+            otu = cat_filter(otu, metadata, p_column, p_column_value,
+                             p_column_quant, p_filter_expr)
         if p_filter_prevalence or p_filter_abundance:
-            otu = num_filter(otu, p_filter_prevalence, p_filter_abundance)
+            otu = num_filter(otu, p_filter_prevalence,
+                             p_filter_abundance, p_filter_mode)
     else:
         if p_filter_prevalence or p_filter_abundance:
-            otu = num_filter(otu, p_filter_prevalence, p_filter_abundance)
-        if m_metadata and p_column:
-            if p_column_value or p_column_quant:
-                otu = cat_filter(otu, m_metadata, p_column, p_column_value, p_column_quant)
+            otu = num_filter(otu, p_filter_prevalence,
+                             p_filter_abundance, p_filter_mode)
+        if has_meta_filter(metadata, p_column, p_column_value,
+                           p_column_quant, p_filter_expr):
+            otu = cat_filter(otu, metadata, p_column, p_column_value,
+                             p_column_quant, p_filter_expr)
     return otu
 
+
+def do_filter_biom(i_table: str,
+                   metadata: pd.DataFrame,
+                   p_filter_prevalence: float,
+                   p_filter_abundance: float,
+                   p_filter_order: str,
+                   p_column: str,
+                   p_column_value: tuple,
+                   p_column_quant: int,
+                   p_filter_mode: str = 'sample',
+                   p_filter_expr: str = None) -> pd.DataFrame:
+
+    samples = None
+    if p_filter_order == 'meta-filter' and has_meta_filter(
+            metadata, p_column, p_column_value, p_column_quant, p_filter_expr):
+        samples = get_cat_samples(metadata, p_column, p_column_value,
+                                  p_column_quant, p_filter_expr)
+    # only read the columns of the samples that passed the metadata filter
+    otu_mat, features, samples = read_biom(i_table, samples)
+    if p_filter_order == 'meta-filter':
+        if p_filter_prevalence or p_filter_abundance:
+            rows, cols = get_num_filter(otu_mat, p_filter_prevalence,
+                                        p_filter_abundance, p_filter_mode)
+            otu_mat = otu_mat[np.flatnonzero(rows)][:, np.flatnonzero(cols)]
+            features = [x for x, r in zip(features, rows) if r]
+            samples = [x for x, c in zip(samples, cols) if c]
+        return pd.DataFrame.sparse.from_spmatrix(
+            otu_mat, index=pd.Index(features), columns=samples)
+    otu = pd.DataFrame.sparse.from_spmatrix(
+        otu_mat, index=pd.Index(features), columns=samples)
+    return do_filter(otu, metadata, p_filter_prevalence,
+                     p_filter_abundance, p_filter_order,
+                     p_column, p_column_value, p_column_quant, p_filter_mode,
+                     p_filter_expr)
+
+
+def do_filter_tsv(i_table: str,
+                  metadata: pd.DataFrame,
+                  p_filter_prevalence: float,
+                  p_filter_abundance: float,
+                  p_filter_order: str,
+                  p_column: str,
+                  p_column_value: tuple,
+                  p_column_quant: int,
+                  p_filter_mode: str = 'sample',
+                  p_filter_expr: str = None) -> pd.DataFrame:
+
+    samples = None
+    if has_meta_filter(metadata, p_column, p_column_value,
+                       p_column_quant, p_filter_expr):
+        samples = get_cat_samples(metadata, p_column, p_column_value,
+                                  p_column_quant, p_filter_expr)
+    if p_filter_prevalence or p_filter_abundance:
+        if p_filter_order == 'meta-filter':
+            # only read the columns of the samples that passed the metadata
+            # filter, and only keep the features that pass the num filter
+            return stream_num_filter(i_table, p_filter_prevalence,
+                                     p_filter_abundance, samples, p_filter_mode)
+        otu = stream_num_filter(i_table, p_filter_prevalence,
+                                p_filter_abundance, None, p_filter_mode)
+    else:
+        otu = read_table(i_table, samples)
+    if samples is not None:
+        samples = set(samples)
+        otu = otu.loc[:, [x for x in otu.columns if x in samples]]
+    return otu
@@ -6,46 +6,288 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
-from os.path import splitext
+import numpy as np
 import pandas as pd
 import phate
-import itertools
+import graphtools
+from scipy import sparse
+from scipy.linalg import orthogonal_procrustes
+from scipy.spatial import procrustes
+from scipy.spatial.distance import pdist, squareform
+from scipy.cluster.hierarchy import cut_tree, linkage
+from sklearn.cluster import KMeans
+from sklearn.decomposition import PCA, TruncatedSVD
+from sklearn.neighbors import NearestNeighbors
 
+from Xphate.tables import attach_matrix
 
-def run_phate(fpo, fpo_3d, tab_norm, knn, decays, ts, n_jobs, make_3d, verbose):
-    data_phates = []
-    data_phates_3d = []
+# the normalised (PCA-reduced) table, attached once per worker process
+SHARED = {}
+
+
+def init_worker(spec: dict, samples: list) -> None:
+    # keep the shared memory blocks referenced as long as the worker lives
+    SHARED['shms'], SHARED['data'] = attach_matrix(spec)
+    SHARED['samples'] = samples
+
+
+def reduce_data(data, n_pca: int = 100, svd_iter: int = None,
+                svd_oversamples: int = 10):
+    # same pre-reduction as the PHATE graph would do on its own, done once
+    # for the whole grid
+    if not n_pca or n_pca >= min(data.shape):
+        return data
+    if sparse.issparse(data):
+        svd = TruncatedSVD(n_pca, n_iter=(svd_iter if svd_iter else 5),
+                           n_oversamples=svd_oversamples)
+    else:
+        svd = PCA(n_pca, svd_solver='randomized',
+                  iterated_power=(svd_iter if svd_iter else 'auto'),
+                  n_oversamples=svd_oversamples)
+    return svd.fit_transform(data)
+
+
+def get_knn_graph(data, knn: int, decays: list, n_jobs: int,
+                  thresh: float = 1e-4, search_multiplier: int = 6) -> tuple:
+    n_samples = data.shape[0]
+    # each sample is its own first neighbour
+    knn = min(knn + 1, n_samples)
+    nn = NearestNeighbors(n_neighbors=knn, n_jobs=n_jobs).fit(data)
+    distances, indices = nn.kneighbors(
+        data, n_neighbors=min(knn * search_multiplier, n_samples))
+    bandwidth = np.maximum(distances[:, knn - 1], np.finfo(float).eps)
+    # the smallest decay has the heaviest kernel tails, so searching up
+    # to its radius collects every neighbour needed by the other decays
+    radius = bandwidth * np.power(-1 * np.log(thresh), 1 / min(decays))
+    update_idx = np.flatnonzero(distances.max(1) < radius)
+    distances, indices = list(distances), list(indices)
+    if len(update_idx):
+        dist_new, ind_new = nn.radius_neighbors(
+            data[update_idx], radius=radius[update_idx].max())
+        for i, idx in enumerate(update_idx):
+            distances[idx] = dist_new[i]
+            indices[idx] = ind_new[i]
+    indptr = np.concatenate([[0], np.cumsum([len(x) for x in indices])])
+    knn_dist = sparse.csr_matrix(
+        (np.concatenate(distances), np.concatenate(indices), indptr),
+        shape=(n_samples, n_samples))
+    return knn_dist, bandwidth
+
+
+def get_decay_kernel(knn_dist: sparse.csr_matrix, bandwidth: np.ndarray,
+                     decay: int, thresh: float = 1e-4) -> sparse.csr_matrix:
+    kernel = knn_dist.copy()
+    rows = np.repeat(np.arange(kernel.shape[0]), np.diff(kernel.indptr))
+    kernel.data = np.exp(-1 * np.power(kernel.data / bandwidth[rows], decay))
+    kernel.data[kernel.data < thresh] = 0
+    kernel.eliminate_zeros()
+    return kernel
+
+
+def get_optimal_t(phate_op: phate.PHATE, t_max: int = 100) -> tuple:
+    # von Neumann entropy knee search, done once per fitted operator
+    t, entropy = phate_op._von_neumann_entropy(t_max=t_max)
+    t_opt = int(phate.vne.find_knee_point(y=entropy, x=t))
+    phate_op.optimal_t = t_opt
+    vne = pd.DataFrame({'t': t, 'entropy': entropy})
+    vne['optimal_t'] = t_opt
+    return t_opt, vne
+
+
+def get_diff_potentials(phate_op: phate.PHATE, ts: list, t_auto: int = None):
+    # power the fitted diffusion operator from one t to the next instead of
+    # starting over from the operator at each t of the sweep
+    diff_op = phate_op.diff_op
+    diff_op_t, prev_t, steps = None, 0, {}
+    for t_ in ts:
+        t = t_ if t_ else t_auto
+        if diff_op_t is None or t < prev_t:
+            diff_op_t = np.linalg.matrix_power(diff_op, t)
+        else:
+            step = t - prev_t
+            if step not in steps:
+                steps[step] = np.linalg.matrix_power(diff_op, step)
+            diff_op_t = diff_op_t @ steps[step]
+        prev_t = t
+        # same "log" potential as PHATE (gamma=1), small values handled
+        yield (t_ if t_ else 'auto'), -1 * np.log(diff_op_t + 1e-7)
+
+
+def get_embedding(phate_op: phate.PHATE, init: np.ndarray) -> np.ndarray:
+    # metric MDS on the potential, started from the embedding of the previous
+    # grid point instead of from a classical MDS
+    if isinstance(phate_op.graph, graphtools.graphs.LandmarkGraph):
+        # each landmark at the mean previous position of its samples
+        init = pd.DataFrame(init).groupby(phate_op.graph.clusters).mean().values
+    potential_dist = pdist(phate_op._diff_potential)
+    init_dist = pdist(init)
+    init = init * np.dot(potential_dist, init_dist) / (
+        np.dot(init_dist, init_dist))
+    potential_dist = squareform(potential_dist)
+    n_samples = potential_dist.shape[0]
+    if phate_op.mds_solver == 'sgd':
+        # already close to the solution: half of the annealing schedule
+        # used by phate.sgd_mds.sgd_mds_metric
+        if n_samples < 1000:
+            n_iter, pairs_per_iter = 150, n_samples * n_samples // 10
+        else:
+            n_iter = 250 if n_samples < 5000 else 400
+            pairs_per_iter = int(n_samples * np.log(n_samples) * 2)
+        embedding = phate.sgd_mds.sgd_mds(
+            potential_dist, n_components=init.shape[1], n_iter=n_iter,
+            init=init, random_state=phate_op.random_state,
+            pairs_per_iter=pairs_per_iter)
+    else:
+        embedding = phate.mds.smacof(
+            potential_dist, n_components=init.shape[1], init=init,
+            random_state=phate_op.random_state,
+            metric=(phate_op.mds == 'metric'))
+    # centered and scaled as the embeddings of PHATE
+    embedding = embedding - embedding.mean(0)
+    phate_op.embedding = embedding / np.linalg.norm(embedding)
+    if isinstance(phate_op.graph, graphtools.graphs.LandmarkGraph):
+        return phate_op.graph.interpolate(phate_op.embedding)
+    return phate_op.embedding
+
+
+def align_embeddings(embeddings: list, columns: list) -> None:
+    # rotate each embedding onto the one of the previous grid point
+    for prev, cur in zip(embeddings[:-1], embeddings[1:]):
+        rotation, _ = orthogonal_procrustes(
+            cur[columns].values, prev[columns].values)
+        cur[columns] = cur[columns].values @ rotation
+
+
+def get_embedding_3d(phate_op: phate.PHATE) -> np.ndarray:
+    # 3D MDS on the potential already computed for the 2D embedding, started
+    # from the 2D solution plus the third axis of a (cheap) classical MDS
+    potential_dist = pdist(phate_op._diff_potential)
+    embedding_dist = pdist(phate_op.embedding)
+    # the 2D embedding is standardised: bring it back to the potential scale
+    init = phate_op.embedding * np.dot(potential_dist, embedding_dist) / (
+        np.dot(embedding_dist, embedding_dist))
+    potential_dist = squareform(potential_dist)
+    embedding_3d = phate.mds.classic(
+        potential_dist, n_components=3, random_state=phate_op.random_state)
+    if phate_op.mds != 'classic':
+        init = np.hstack([init, embedding_3d[:, 2:]])
+        if phate_op.mds_solver == 'sgd':
+            embedding_3d = phate.sgd_mds.sgd_mds_metric(
+                potential_dist, n_components=3, init=init,
+                random_state=phate_op.random_state)
+        else:
+            embedding_3d = phate.mds.smacof(
+                potential_dist, n_components=3, init=init,
+                random_state=phate_op.random_state,
+                metric=(phate_op.mds == 'metric'))
+        # same orientation as the 2D embedding
+        _, embedding_3d, _ = procrustes(init, embedding_3d)
+    if isinstance(phate_op.graph, graphtools.graphs.LandmarkGraph):
+        return phate_op.graph.interpolate(embedding_3d)
+    return embedding_3d
+
+
+def get_clusters(diff_potential: np.ndarray, cluster_ks: list,
+                 cluster_method: str) -> dict:
+    # all the k of the sweep from a single clustering pass
+    clusters = {}
+    if not cluster_ks:
+        return clusters
+    if cluster_method == 'hierarchical':
+        # one ward tree, cut at every k
+        labels = cut_tree(linkage(diff_potential, method='ward'),
+                          n_clusters=cluster_ks)
+        for kdx, k in enumerate(cluster_ks):
+            clusters[k] = labels[:, kdx]
+    else:
+        # k-means warm-started from the centers of the previous k, plus
+        # the samples the furthest away from their cluster center
+        # (a few restarts only for the smallest k, which seeds all the others)
+        centers, labels = None, None
+        for k in sorted(cluster_ks):
+            if centers is None:
+                kmeans = KMeans(k, n_init=3)
+            else:
+                dists = ((diff_potential - centers[labels]) ** 2).sum(1)
+                far = np.argsort(dists)[::-1][:(k - centers.shape[0])]
+                init = np.vstack([centers, diff_potential[far]])
+                kmeans = KMeans(k, init=init, n_init=1)
+            kmeans.fit(diff_potential)
+            centers, labels = kmeans.cluster_centers_, kmeans.labels_
+            clusters[k] = labels
+    return clusters
+
+
+def run_phate(knn, decays, ts, n_jobs, make_3d, share_knn, write_vne,
+              cluster_ks, cluster_method, warm_mds, scale_params, verbose):
+    # one (grid point, 2D, 3D, entropy) result per (knn, decay, t) point
+    results = []
+    knn_ = knn
     if not knn:
         knn = 5
-    for (decay, t) in itertools.product(*[decays, ts]):
-        if not decay:
-            decay = 15
-        if not t:
-            t = 'auto'
+    decays_ = decays
+    decays = [decay if decay else 15 for decay in decays]
+    # the table is already reduced (PCA) for the whole grid
+    data, samples = SHARED['data'], SHARED['samples']
+    if share_knn:
+        knn_dist, bandwidth = get_knn_graph(data, knn, decays, n_jobs)
+    # embeddings that the next grid points start from
+    init_decay = None
+    for decay_, decay in zip(decays_, decays):
+        init = init_decay
         phate_op = phate.PHATE()
         phate_op.set_params(
-            knn=knn, decay=decay, t=t, n_jobs=n_jobs, verbose=verbose)
-        phate_fit = phate_op.fit_transform(tab_norm)
-        data_phate = pd.DataFrame(phate_fit, columns=['PHATE1', 'PHATE2'])
-        data_phate['knn'] = knn
-        data_phate['decay'] = decay
-        data_phate['t'] = t
-        data_phate['sample_name'] = tab_norm.index.tolist()
-        for k in range(2, 11):
-            phate_clusters = phate.cluster.kmeans(phate_op, n_clusters=k)
-            data_phate['cluster_k%s' % k] = phate_clusters
-        data_phates.append(data_phate)
-        if make_3d:
-            phate_op.set_params(n_components=3)
-            phate_3d = phate_op.transform()
-            data_phate_3d = pd.DataFrame(
-                phate_3d, columns=['PHATE1', 'PHATE2', 'PHATE3'])
-            data_phate_3d['knn'] = knn
-            data_phate_3d['decay'] = decay
-            data_phate_3d['t'] = t
-            data_phate_3d['sample_name'] = tab_norm.index.tolist()
-            data_phates_3d.append(data_phate_3d)
-
-    pd.concat(data_phates).to_csv(fpo, index=False, sep='\t')
-    if make_3d:
-        pd.concat(data_phates_3d).to_csv(fpo_3d, index=False, sep='\t')
+            knn=knn, decay=decay, n_jobs=n_jobs, verbose=verbose, n_pca=None,
+            n_landmark=scale_params['n_landmark'],
+            mds_solver=scale_params['mds_solver'])
+        if share_knn:
+            phate_op.set_params(knn_dist='precomputed_affinity')
+            phate_op.fit(get_decay_kernel(knn_dist, bandwidth, decay))
+        else:
+            phate_op.fit(data)
+        t_auto, data_vne = None, None
+        if write_vne or not all(ts):
+            t_auto, data_vne = get_optimal_t(phate_op)
+            data_vne['knn'] = knn
+            data_vne['decay'] = decay
+            if not write_vne:
+                data_vne = None
+        for tdx, (t_, (t, diff_potential)) in enumerate(zip(
+                ts, get_diff_potentials(phate_op, ts, t_auto))):
+            phate_op.set_params(t=t, n_components=2)
+            phate_op._diff_potential = diff_potential
+            if warm_mds and init is not None and phate_op.mds != 'classic':
+                phate_fit = get_embedding(phate_op, init)
+            else:
+                phate_fit = phate_op.transform()
+            # previous t for the next t, first t for the next decay
+            if not tdx:
+                init_decay = phate_fit
+            init = phate_fit
+            data_phate = pd.DataFrame(phate_fit, columns=['PHATE1', 'PHATE2'])
+            data_phate['knn'] = knn
+            data_phate['decay'] = decay
+            data_phate['t'] = t
+            data_phate['sample_name'] = samples
+            phate_clusters = get_clusters(
+                phate_op.diff_potential, cluster_ks, cluster_method)
+            for k, labels in phate_clusters.items():
+                data_phate['cluster_k%s' % k] = labels
+            data_phate_3d = None
+            if make_3d:
+                # only when asked for, from the potential of the 2D fit
+                phate_3d = get_embedding_3d(phate_op)
+                data_phate_3d = pd.DataFrame(
+                    phate_3d, columns=['PHATE1', 'PHATE2', 'PHATE3'])
+                data_phate_3d['knn'] = knn
+                data_phate_3d['decay'] = decay
+                data_phate_3d['t'] = t
+                data_phate_3d['sample_name'] = samples
+            results.append(
+                ((knn_, decay_, t_), data_phate, data_phate_3d, data_vne))
+    # the results go back to the parent as they are (pickled, no text)
+    return results
+
+
+def run_task(args: tuple) -> list:
+    return run_phate(*args)
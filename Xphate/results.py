@@ -0,0 +1,146 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the MIT License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+from os.path import dirname, isdir, isfile
+from scipy import sparse
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = None
+
+PARTITIONS = ['knn', 'decay', 't']
+
+
+def check_pyarrow() -> None:
+    if pa is None:
+        raise ImportError('The parquet results store requires pyarrow '
+                          '(pip install pyarrow)')
+
+
+def get_partitioning():
+    # partition values read as strings (`t` may be "auto")
+    check_pyarrow()
+    return ds.partitioning(
+        pa.schema([(x, pa.string()) for x in PARTITIONS]), flavor='hive')
+
+
+def write_results(pds: pd.DataFrame, fpo_base: str, res_format: str) -> str:
+    if res_format == 'parquet':
+        check_pyarrow()
+        fpo = '%s.parquet' % fpo_base
+        if isdir(fpo):
+            # the store is rewritten, not appended to
+            shutil.rmtree(fpo)
+        pds = pds.copy()
+        for col in pds.columns:
+            if col in PARTITIONS:
+                pds[col] = pds[col].astype(str)
+            elif col in ['sample_name', 'variable', 'dtype']:
+                pds[col] = pds[col].astype('category')
+        pds.to_parquet(fpo, partition_cols=PARTITIONS, index=False)
+    else:
+        fpo = '%s.tsv' % fpo_base
+        pds.to_csv(fpo, index=False, sep='\t')
+    return fpo
+
+
+def is_store(i_res: str) -> bool:
+    return isdir(i_res) or i_res.endswith('.parquet')
+
+
+def filter_points(pds: pd.DataFrame, knns: list, decays: list,
+                  ts: list) -> pd.DataFrame:
+    # only keep the rows of the requested parameters
+    for col, values in zip(PARTITIONS, [knns, decays, ts]):
+        if list(values) != [None] and col in pds.columns:
+            pds = pds.loc[pds[col].astype(str).isin([str(x) for x in values])]
+    return pds
+
+
+def read_results(i_res: str, knns: list, decays: list, ts: list) -> pd.DataFrame:
+    if not is_store(i_res):
+        return filter_points(pd.read_csv(
+            i_res, header=0, sep='\t', dtype={'sample_name': str}),
+            knns, decays, ts)
+    # only read the partitions of the requested parameters
+    filters = []
+    for col, values in zip(PARTITIONS, [knns, decays, ts]):
+        if list(values) != [None]:
+            filters.append((col, 'in', [str(x) for x in values]))
+    pds = pd.read_parquet(i_res, filters=(filters if filters else None),
+                          partitioning=get_partitioning())
+    for col in pds.columns:
+        if str(pds[col].dtype) == 'category':
+            pds[col] = pds[col].astype(str)
+    for col in PARTITIONS:
+        try:
+            pds[col] = pds[col].astype(int)
+        except ValueError:
+            pass
+    return pds
+
+
+def stack_clusters(pds: pd.DataFrame) -> pd.DataFrame:
+    # the results tables hold the clusters of each k in long format
+    cols = [x for x in pds.columns if 'cluster' in x]
+    if not cols:
+        return pds
+    return pds.set_index(
+        [x for x in pds.columns if x not in cols]
+    ).rename_axis('variable', axis=1).stack().reset_index(name='factor')
+
+
+def unstack_clusters(pds: pd.DataFrame) -> pd.DataFrame:
+    # one row per sample and knn/decay/t point, one column per k
+    if 'variable' not in pds.columns:
+        return pds
+    return pds.set_index(
+        [x for x in pds.columns if x not in ['variable', 'factor', 'dtype']]
+        + ['variable'])['factor'].unstack('variable').rename_axis(
+        None, axis=1).reset_index()
+
+
+def get_table_hash(tab_norm: sparse.csr_matrix, samples: list) -> str:
+    table_hash = hashlib.sha1(str(tab_norm.shape).encode())
+    for arr in [tab_norm.data, tab_norm.indices, tab_norm.indptr]:
+        table_hash.update(np.ascontiguousarray(arr))
+    table_hash.update('\t'.join(map(str, samples)).encode())
+    return table_hash.hexdigest()
+
+
+def get_cache_path(p_cache_dir: str, table_hash: str, params: dict) -> str:
+    # one entry per grid point: the filtered, normalised table hash and
+    # the hash of the parameters that went into the embedding
+    params_hash = hashlib.sha1(
+        json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+    return '%s/%s/%s.pkl' % (p_cache_dir, table_hash, params_hash)
+
+
+def read_cache(cache_path: str, make_3d: bool, write_vne: bool) -> tuple:
+    if not isfile(cache_path):
+        return None
+    entry = pd.read_pickle(cache_path)
+    if make_3d and entry[1] is None or write_vne and entry[2] is None:
+        return None
+    return entry
+
+
+def write_cache(cache_path: str, entry: tuple) -> None:
+    # written aside and then moved, so that an interrupted
+    # run never leaves a half-written entry behind
+    os.makedirs(dirname(cache_path), exist_ok=True)
+    pd.to_pickle(entry, '%s.tmp' % cache_path)
+    os.replace('%s.tmp' % cache_path, cache_path)
@@ -15,11 +15,12 @@ from Xphate import __version__
 @click.command()
 @click.option(
     "-i", "--i-table", required=False, type=str,
-    help="Features table, input path."
+    help="Features table (TSV or BIOM v2.1 HDF5), input path."
 )
 @click.option(
     "-j", "--i-res", required=False, type=str,
-    help="Table to make figure from."
+    help="Table (TSV) or results store (parquet) to make figure from "
+         "(for a store, only the partitions of `-k`, `-d` and `-t` are read)."
 )
 @click.option(
     "-o", "--o-html", required=True, type=str,
@@ -48,6 +49,12 @@ from Xphate import __version__
     default=0, help="Filtering quantile / percentile for samples based on"
                     " column passed to `-c` (must be between 0 and 100)."
 )
+@click.option(
+    "-e", "--p-filter-expr", required=False, default=None,
+    help="Filtering expression to select samples on several metadata columns "
+         "(e.g. \"ph > 6 & body_site in {gut,skin} & age >= q25\"; `qNN` is "
+         "the NN-th percentile of the column)."
+)
 @click.option(
     "-fp", "--p-filter-prevalence", required=False, type=float,
     default=0, help="Filter features based on their minimum sample prevalence "
@@ -58,6 +65,13 @@ from Xphate import __version__
     default=0, help="Filter features based on their minimum sample abundance "
                     "(number >1 for abundance counts: <1 for abundance fraction)."
 )
+@click.option(
+    "-fm", "--p-filter-mode", required=False, default='sample',
+    type=click.Choice(['sample', 'dataset', 'both']), show_default=True,
+    help="Level of the abundance filter: 'sample' the abundance in at least "
+         "`-fp` samples; 'dataset' the abundance in the whole dataset; "
+         "'both' the 'sample' and then the 'dataset' filter."
+)
 @click.option(
     "-f", "--p-filter-order", required=False, default='meta-filter',
     type=click.Choice(['meta-filter', 'filter-meta']),
@@ -79,16 +93,126 @@ from Xphate import __version__
 )
 @click.option(
     "-n", "--p-cpus", required=False, type=int,
-    default=1, help="Number of jobs."
+    default=1, help="Number of jobs (size of the pool of workers "
+                    "running the knn x decay x t grid, and rendering the "
+                    "`--separate` figures)."
+)
+@click.option(
+    "--clusters/--no-clusters", default=False,
+    help="Cluster the samples on the PHATE potential (and show the clusters)."
 )
 @click.option(
-    "--clusters/--no-clusters", default=False
+    "--p-cluster-ks", required=False, type=int, nargs=2, default=(2, 10),
+    show_default=True, help="Min and Max number of clusters `k`."
+)
+@click.option(
+    "--p-cluster-method", required=False, default='kmeans',
+    type=click.Choice(['kmeans', 'hierarchical']), show_default=True,
+    help="'kmeans': k-means warm-started from one k to the next; "
+         "'hierarchical': one ward linkage tree cut at each k."
 )
 @click.option(
     "--separate/--no-separate", default=False
 )
 @click.option(
-    "--make_3d/--no-make_3d", default=True
+    "--make_3d/--no-make_3d", default=False, show_default=True,
+    help="Also embed the samples in 3D (written to a `_3d` table and "
+         "shown as a rotatable view in the html)."
+)
+@click.option(
+    "--share-knn/--no-share-knn", default=True, show_default=True,
+    help="Search the nearest neighbours once per `knn` and only rebuild "
+         "the alpha-decay kernel for each `decay`."
+)
+@click.option(
+    "--vne/--no-vne", "write_vne", default=False, show_default=True,
+    help="Write the von Neumann entropy curve used to select `t` "
+         "automatically (and the selected `t`) for each knn/decay."
+)
+@click.option(
+    "-r", "--p-res-format", required=False, default='tsv',
+    type=click.Choice(['tsv', 'parquet']), show_default=True,
+    help="Format of the results: 'tsv' tables or a 'parquet' store "
+         "partitioned by knn/decay/t (requires pyarrow)."
+)
+@click.option(
+    "-x", "--p-cache-dir", required=False, type=str, default=None,
+    help="Cache folder for the embeddings of each knn/decay/t point: a "
+         "re-run on the same (filtered) table only computes the missing "
+         "points."
+)
+@click.option(
+    "--warm-mds/--no-warm-mds", default=False, show_default=True,
+    help="Start the MDS of each knn/decay/t point from the embedding of "
+         "the previous point (with a shorter SGD schedule)."
+)
+@click.option(
+    "--align-mds/--no-align-mds", default=False, show_default=True,
+    help="Rotate the embedding of each knn/decay/t point onto the one of "
+         "the previous point (Procrustes), for steadier plots."
+)
+@click.option(
+    "--p-n-landmark", required=False, type=int, default=2000,
+    show_default=True, help="Number of landmarks of the diffusion "
+                            "operator (0 for no landmarks)."
+)
+@click.option(
+    "--p-n-pca", required=False, type=int, default=100, show_default=True,
+    help="Number of principal components to compute the kNN graph on "
+         "(0 for no PCA)."
+)
+@click.option(
+    "--p-mds-solver", required=False, default='sgd',
+    type=click.Choice(['sgd', 'smacof']), show_default=True,
+    help="Solver of the metric MDS."
+)
+@click.option(
+    "--p-svd-iter", required=False, type=int, default=None,
+    help="Number of power iterations of the randomised SVD (PCA) "
+         "[default: scikit-learn's]."
+)
+@click.option(
+    "--p-svd-oversamples", required=False, type=int, default=10,
+    show_default=True, help="Number of oversamples of the randomised SVD (PCA)."
+)
+@click.option(
+    "--auto-scale/--no-auto-scale", default=False, show_default=True,
+    help="Pick the landmarks, PCA, SVD and MDS settings from the numbers "
+         "of samples and features (overrides these options)."
+)
+@click.option(
+    "--pca/--no-pca", "write_pca", default=False, show_default=True,
+    help="Write the PCA of the normalised table (computed once for the "
+         "whole grid; nothing is written if --p-n-pca does not reduce it)."
+)
+@click.option(
+    "--p-html-data", required=False, default='inline',
+    type=click.Choice(['inline', 'sidecar']), show_default=True,
+    help="Data of the html: 'inline' in the page; 'sidecar' in compact "
+         "scripts of a `xphate_data` folder next to the html (smaller page, "
+         "no rows limit, also opens from a local directory as file://; "
+         "see --p-vega-dir to also render offline)."
+)
+@click.option(
+    "--p-max-points", required=False, type=int, default=0,
+    show_default=True, help="Points budget of the charts: above it, only a "
+                            "subsample of the samples is shown, stratified on "
+                            "the categorical metadata (or thinned where the "
+                            "embedding is dense) (0 for all the samples)."
+)
+@click.option(
+    "--p-num-agg", required=False, default='none',
+    type=click.Choice(['none', 'mean', 'median', 'count']), show_default=True,
+    help="Show the numerical variables aggregated in a grid of cells over "
+         "the embedding (colored by the 'mean', 'median' or 'count' of the "
+         "samples of each cell) instead of one point per sample."
+)
+@click.option(
+    "--p-vega-dir", required=False, type=str, default=None,
+    help="Folder with local copies of vega.min.js (v5), vega-lite.min.js "
+         "(v3) and vega-embed.min.js (v4), for the html to render offline: "
+         "copied to the `xphate_data` folder with --p-html-data sidecar, or "
+         "else written in the page [default: loaded from the jsdelivr CDN]."
 )
 @click.option(
     "--verbose/--no-verbose", default=False
@@ -113,6 +237,27 @@ def standalone_xphate(
         clusters,
         separate,
         make_3d,
+        share_knn,
+        write_vne,
+        p_res_format,
+        p_cache_dir,
+        p_cluster_ks,
+        p_cluster_method,
+        warm_mds,
+        align_mds,
+        p_n_landmark,
+        p_n_pca,
+        p_mds_solver,
+        p_svd_iter,
+        p_svd_oversamples,
+        auto_scale,
+        write_pca,
+        p_filter_mode,
+        p_filter_expr,
+        p_html_data,
+        p_max_points,
+        p_num_agg,
+        p_vega_dir,
         verbose
 ):
 
@@ -135,6 +280,27 @@ def standalone_xphate(
         clusters,
         separate,
         make_3d,
+        share_knn,
+        write_vne,
+        p_res_format,
+        p_cache_dir,
+        p_cluster_ks,
+        p_cluster_method,
+        warm_mds,
+        align_mds,
+        p_n_landmark,
+        p_n_pca,
+        p_mds_solver,
+        p_svd_iter,
+        p_svd_oversamples,
+        auto_scale,
+        write_pca,
+        p_filter_mode,
+        p_filter_expr,
+        p_html_data,
+        p_max_points,
+        p_num_agg,
+        p_vega_dir,
         verbose
     )
 
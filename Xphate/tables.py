@@ -0,0 +1,139 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the MIT License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+from scipy import sparse
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+
+
+def get_table_chunks(i_table: str, samples: list = None,
+                     chunksize: int = 1000):
+    # the features table by chunks of rows, as sparse values, so that only
+    # one chunk at a time is ever held as dense values
+    usecols = None
+    if samples is not None:
+        # only the columns of the selected samples
+        header = pd.read_csv(i_table, header=0, index_col=0, sep='\t', nrows=0)
+        samples = set(samples)
+        usecols = [0] + [idx + 1 for idx, sample in enumerate(header.columns)
+                         if sample in samples]
+    for chunk in pd.read_csv(i_table, header=0, index_col=0, sep='\t',
+                             usecols=usecols, chunksize=chunksize):
+        yield chunk.index.tolist(), sparse.csr_matrix(
+            chunk.values, dtype=float), chunk.columns
+
+
+def read_table(i_table: str, samples: list = None,
+               chunksize: int = 1000) -> pd.DataFrame:
+    index, chunks, columns = [], [], []
+    for chunk_index, chunk, columns in get_table_chunks(
+            i_table, samples, chunksize):
+        index.extend(chunk_index)
+        chunks.append(chunk)
+    if chunks:
+        tab = sparse.vstack(chunks).tocsc()
+    else:
+        tab = sparse.csc_matrix((0, len(columns)), dtype=float)
+    return pd.DataFrame.sparse.from_spmatrix(
+        tab, index=pd.Index(index), columns=columns)
+
+
+def get_sparse_matrix(tab: pd.DataFrame) -> sparse.csr_matrix:
+    if tab.shape[1] and all(isinstance(x, pd.SparseDtype) for x in tab.dtypes):
+        return tab.sparse.to_coo().tocsr()
+    return sparse.csr_matrix(tab.values, dtype=float)
+
+
+def is_biom(i_table: str) -> bool:
+    with open(i_table, 'rb') as f:
+        return f.read(8) == HDF5_SIGNATURE
+
+
+def get_biom_ids(ids) -> list:
+    return [x.decode() if isinstance(x, bytes) else str(x) for x in ids[:]]
+
+
+def read_biom(i_table: str, samples: list = None) -> tuple:
+    # BIOM v2.1 (HDF5): the "sample" group stores the table compressed by
+    # sample, so that only the selected samples' values need to be read
+    if h5py is None:
+        raise ImportError('Reading BIOM tables requires h5py '
+                          '(pip install h5py)')
+    with h5py.File(i_table, 'r') as biom:
+        features = get_biom_ids(biom['observation/ids'])
+        sample_ids = get_biom_ids(biom['sample/ids'])
+        indptr = biom['sample/matrix/indptr'][:]
+        if samples is None:
+            idx = np.arange(len(sample_ids))
+        else:
+            samples = set(samples)
+            idx = np.array([i for i, x in enumerate(sample_ids)
+                            if x in samples], dtype=int)
+        data, indices = [], []
+        # read the selected samples by runs of contiguous columns
+        runs = np.split(idx, np.flatnonzero(np.diff(idx) != 1) + 1)
+        for run in runs:
+            if not len(run):
+                continue
+            start, end = indptr[run[0]], indptr[run[-1] + 1]
+            data.append(biom['sample/matrix/data'][start:end])
+            indices.append(biom['sample/matrix/indices'][start:end])
+    sel_indptr = np.concatenate([[0], np.cumsum(
+        indptr[idx + 1] - indptr[idx])])
+    otu_mat = sparse.csc_matrix((
+        np.concatenate(data) if data else np.zeros(0),
+        np.concatenate(indices) if indices else np.zeros(0, dtype=int),
+        sel_indptr), shape=(len(features), len(idx)), dtype=float)
+    return otu_mat, features, [sample_ids[i] for i in idx]
+
+
+def share_matrix(mat) -> tuple:
+    # copy the CSR arrays (or the dense array) once into shared memory blocks
+    shms, spec = [], {'shape': mat.shape, 'sparse': sparse.issparse(mat)}
+    if spec['sparse']:
+        arrays = {attr: getattr(mat, attr)
+                  for attr in ['data', 'indices', 'indptr']}
+    else:
+        arrays = {'array': np.ascontiguousarray(mat)}
+    for attr, arr in arrays.items():
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+        shms.append(shm)
+        spec[attr] = (shm.name, arr.dtype.str, arr.shape)
+    return shms, spec
+
+
+def attach_matrix(spec: dict) -> tuple:
+    # zero-copy, read-only CSR (or dense array) on the shared memory blocks
+    shms, arrays = [], []
+    attrs = ['data', 'indices', 'indptr'] if spec['sparse'] else ['array']
+    for attr in attrs:
+        name, dtype, shape = spec[attr]
+        shm = shared_memory.SharedMemory(name=name)
+        arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        arr.flags.writeable = False
+        shms.append(shm)
+        arrays.append(arr)
+    if not spec['sparse']:
+        return shms, arrays[0]
+    mat = sparse.csr_matrix(tuple(arrays), shape=spec['shape'], copy=False)
+    return shms, mat
+
+
+def release_matrix(shms: list) -> None:
+    for shm in shms:
+        shm.close()
+        shm.unlink()
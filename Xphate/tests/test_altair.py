@@ -0,0 +1,59 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the MIT License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import re
+import json
+import numpy as np
+import pandas as pd
+
+from Xphate.altair import get_libraries, make_figure
+
+
+def get_page_datasets(o_html: str) -> list:
+    with open(o_html) as f:
+        html = f.read()
+    return [json.loads(x) for x in re.findall(
+        r'XPHATE_DATA\[".*?"\] = (.*?);</script>', html)]
+
+
+def test_separate_pages_keep_the_whole_vne_curve(tmp_path):
+    rng = np.random.RandomState(0)
+    samples = ['s%s' % x for x in range(20)]
+    full_pds = pd.concat([pd.DataFrame({
+        'PHATE1': rng.randn(20), 'PHATE2': rng.randn(20), 'knn': 10,
+        'decay': 20, 't': t, 'sample_name': samples}) for t in [5, 10]])
+    vne_pds = pd.DataFrame({
+        't': range(30), 'entropy': np.linspace(3, 1, 30), 'optimal_t': 13,
+        'knn': 10, 'decay': 20})
+    o_html = str(tmp_path / 'out.html')
+    make_figure('table.tsv', None, o_html, full_pds, pd.DataFrame(), vne_pds,
+                [5, 10], 5, [20], 0, [10], 0, False, True)
+    for t in [5, 10]:
+        page = str(tmp_path / ('out_t%s-knn10-decay20.html' % t))
+        vne = [x for x in get_page_datasets(page) if 'entropy' in x]
+        assert len(vne) == 1
+        assert vne[0]['t'] == list(range(30))
+        assert 13 in vne[0]['optimal_t']
+        with open(page) as f:
+            assert 'PHATE for table \\"table.tsv\\"' in f.read()
+
+
+def test_local_vega_libraries(tmp_path):
+    vega_dir = tmp_path / 'vega'
+    vega_dir.mkdir()
+    for lib in ['vega', 'vega-lite', 'vega-embed']:
+        (vega_dir / ('%s.min.js' % lib)).write_text('var lib = "%s";' % lib)
+    assert get_libraries(None, 'sidecar', str(tmp_path)).count(
+        'src="https://cdn.jsdelivr.net/npm/') == 3
+    sidecar = get_libraries(str(vega_dir), 'sidecar', str(tmp_path))
+    assert 'http' not in sidecar
+    for lib in ['vega', 'vega-lite', 'vega-embed']:
+        assert 'src="xphate_data/%s.js"' % lib in sidecar
+        assert (tmp_path / 'xphate_data' / ('%s.js' % lib)).is_file()
+    inline = get_libraries(str(vega_dir), 'inline', str(tmp_path))
+    assert 'src=' not in inline and 'var lib = "vega-embed";' in inline
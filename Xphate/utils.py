@@ -7,6 +7,7 @@
 # ----------------------------------------------------------------------------
 
 import pandas as pd
+from os.path import isfile
 
 
 def get_param(p_param, param, suffix):
@@ -24,19 +25,85 @@ def get_param(p_param, param, suffix):
     return param_step, param_range
 
 
-def get_metadata(m_metadata: str, p_columns: tuple) -> (pd.DataFrame, str):
-    metadata = pd.DataFrame()
-    columns = []
-    if m_metadata:
-        with open(m_metadata) as f:
-            for line in f:
-                break
-        first_var = line.split('\t')[0]
-        metadata = pd.read_csv(m_metadata, header=0, sep='\t', dtype={first_var: str})
-        metadata = metadata.rename(columns={first_var: 'sample_name'})
-        cols = [x.replace('\n', '') for x in metadata.columns]
-        metadata.columns = cols
-        for p_column in p_columns:
-            if p_column in cols:
-                columns.append(p_column)
-    return metadata, columns
+def get_chunks(values: list, n_chunks: int) -> list:
+    # contiguous chunks, so that a chunk of t values stays a sweep
+    values = list(values)
+    n_chunks = max(1, min(n_chunks, len(values)))
+    size, rest = divmod(len(values), n_chunks)
+    chunks, start = [], 0
+    for chunk in range(n_chunks):
+        end = start + size + (chunk < rest)
+        chunks.append(values[start:end])
+        start = end
+    return chunks
+
+
+def get_tasks(grid: list, n_cpus: int) -> list:
+    # split the (knn, decay, t) grid points by knn, then by decays and
+    # only if there are still idle cpus by t, so that each task keeps the
+    # kNN search and the fits shared by as many grid points as possible
+    groups = {}
+    for (knn, decay, t) in grid:
+        groups.setdefault(knn, {}).setdefault(decay, []).append(t)
+    knn_groups = []
+    for knn, decays_ts in groups.items():
+        # decays sharing the same t values to sweep
+        ts_decays = {}
+        for decay, ts in decays_ts.items():
+            ts_decays.setdefault(tuple(ts), []).append(decay)
+        for ts, decays in ts_decays.items():
+            knn_groups.append((knn, decays, list(ts)))
+    tasks = []
+    if not knn_groups:
+        return tasks
+    n_decays_chunks = -(-n_cpus // len(knn_groups))
+    for (knn, decays, ts) in knn_groups:
+        for decays_chunk in get_chunks(decays, n_decays_chunks):
+            tasks.append((knn, decays_chunk, ts))
+    if len(tasks) < n_cpus:
+        n_ts_chunks = -(-n_cpus // len(tasks))
+        tasks = [(knn, decays_chunk, ts_chunk)
+                 for (knn, decays_chunk, ts) in tasks
+                 for ts_chunk in get_chunks(ts, n_ts_chunks)]
+    return tasks
+
+
+def get_scale_params(n_samples: int, n_features: int, n_landmark: int,
+                     n_pca: int, mds_solver: str, svd_iter: int,
+                     svd_oversamples: int, auto_scale: bool) -> dict:
+    if auto_scale:
+        # the transitions of the samples to the landmarks are dense: fewer
+        # landmarks past 50,000 samples (at most 1e8 values, i.e. ~800MB)
+        n_landmark = int(min(2000, max(500, 1e8 // n_samples)))
+        # fewer components and power iterations for the randomised SVD of
+        # the largest tables
+        n_pca = 100 if n_samples < 100000 else 50
+        svd_iter = None if n_samples * n_features < 1e9 else 2
+        svd_oversamples = 10
+        # smacof is still cheap (and more accurate) on small problems
+        mds_solver = 'smacof' if min(n_samples, n_landmark) <= 500 else 'sgd'
+    scale_params = {
+        'n_landmark': n_landmark if n_landmark else None,
+        'n_pca': n_pca if n_pca else None,
+        'mds_solver': mds_solver,
+        'svd_iter': svd_iter,
+        'svd_oversamples': svd_oversamples
+    }
+    return scale_params
+
+
+def get_metadata(m_metadata: str, columns: list = None) -> pd.DataFrame:
+    # parsed once (only the columns used to filter or label the samples)
+    # and indexed by sample name for both the filtering and the merging
+    if not isfile(m_metadata):
+        raise IOError('No metadata file named', m_metadata)
+    with open(m_metadata) as f:
+        header = f.readline().rstrip('\n').split('\t')
+        usecols = None
+        if columns is not None:
+            columns = set(columns)
+            usecols = [header[0]] + [x for x in header[1:] if x in columns]
+        metadata = pd.read_csv(
+            f, header=None, names=header, sep='\t', usecols=usecols,
+            dtype={header[0]: str}, index_col=0)
+    return metadata.rename_axis('sample_name')
@@ -8,15 +8,27 @@
 
 import os
 import sys
+import itertools
 import pandas as pd
 from os.path import abspath, dirname, isfile, isdir, splitext
 
 import multiprocessing as mp
+from scipy import sparse
 from sklearn.preprocessing import normalize
 
-from Xphate.filter import do_filter
-from Xphate.utils import get_metadata, get_param
-from Xphate.phate import run_phate
+from Xphate.tables import (
+    read_table, is_biom, get_sparse_matrix, share_matrix, release_matrix)
+from Xphate.filter import (
+    do_filter_tsv, do_filter_biom, get_expr_tree, get_expr_columns,
+    has_meta_filter)
+from Xphate.utils import (
+    get_metadata, get_param, get_tasks, get_scale_params)
+from Xphate.phate import (
+    init_worker, reduce_data, run_task, align_embeddings)
+from Xphate.results import (
+    read_results, write_results, stack_clusters, unstack_clusters,
+    get_table_hash,
+    get_cache_path, read_cache, write_cache)
 from Xphate.altair import make_figure
 
 
@@ -38,7 +50,28 @@ def xphate(
         p_jobs: int = 1,
         clusters: bool = False,
         separate: bool = False,
-        make_3d: bool = True,
+        make_3d: bool = False,
+        share_knn: bool = True,
+        write_vne: bool = False,
+        p_res_format: str = 'tsv',
+        p_cache_dir: str = None,
+        p_cluster_ks: tuple = (2, 10),
+        p_cluster_method: str = 'kmeans',
+        warm_mds: bool = False,
+        align_mds: bool = False,
+        p_n_landmark: int = 2000,
+        p_n_pca: int = 100,
+        p_mds_solver: str = 'sgd',
+        p_svd_iter: int = None,
+        p_svd_oversamples: int = 10,
+        auto_scale: bool = False,
+        write_pca: bool = False,
+        p_filter_mode: str = 'sample',
+        p_filter_expr: str = None,
+        p_html_data: str = 'inline',
+        p_max_points: int = 0,
+        p_num_agg: str = 'none',
+        p_vega_dir: str = None,
         verbose: bool = False
     ):
 
@@ -52,30 +85,62 @@ def xphate(
     decays_step, decays = get_param(p_decays, 'd', suffix)
     knns_step, knns = get_param(p_knns, 'k', suffix)
 
+    metadata = pd.DataFrame()
+    if m_metadata:
+        if verbose:
+            print('Read metadata...', end='')
+        # the same parsed metadata for the filtering and the merging
+        columns = list(p_columns) if p_columns else []
+        if p_column:
+            columns.extend([p_column, p_column.replace('\\n', '')])
+        if p_filter_expr:
+            columns.extend(get_expr_columns(get_expr_tree(p_filter_expr)))
+        metadata = get_metadata(m_metadata, columns)
+        if verbose:
+            print('done.')
+
+    vne_pds, full_pds_3d = pd.DataFrame(), pd.DataFrame()
     if i_res:
         print('i_res', i_res)
-        full_pds = pd.read_csv(i_res, header=0, sep='\t', dtype={'sample_name': str})
+        full_pds = unstack_clusters(read_results(i_res, knns, decays, ts))
+        i_res_3d = '%s_3d%s' % splitext(i_res.rstrip('/'))
+        if make_3d and (isfile(i_res_3d) or isdir(i_res_3d)):
+            full_pds_3d = read_results(i_res_3d, knns, decays, ts)
+        i_res_vne = '%s_vne.tsv' % splitext(i_res.rstrip('/'))[0]
+        if isfile(i_res_vne):
+            vne_pds = pd.read_csv(i_res_vne, header=0, sep='\t')
     else:
         i_table = abspath(i_table)
         if not isfile(i_table):
             raise IOError("No input table found at %s" % i_table)
-        if verbose:
-            print('read')
-        tab = pd.read_csv(i_table, header=0, index_col=0, sep='\t')
-
         o_html = abspath(o_html)
         if not o_html.endswith('.html'):
             o_html = '%s%s.html' % (o_html, suffix)
         if not isdir(dirname(o_html)):
             os.makedirs(dirname(o_html))
 
+        if verbose:
+            print('read')
         message = 'input'
-        if m_metadata and p_column and p_column_value or p_filter_prevalence or p_filter_abundance:
-            # Filter / Transform OTU-table
-            tab = do_filter(tab, m_metadata, p_filter_prevalence,
-                            p_filter_abundance, p_filter_order,
-                            p_column, p_column_value, p_column_quant)
+        if is_biom(i_table):
+            # Filter OTU-table while reading it
+            tab = do_filter_biom(i_table, metadata, p_filter_prevalence,
+                                 p_filter_abundance, p_filter_order,
+                                 p_column, p_column_value, p_column_quant,
+                                 p_filter_mode, p_filter_expr)
             message = 'filtered'
+        else:
+            if has_meta_filter(metadata, p_column, p_column_value,
+                               p_column_quant, p_filter_expr) or \
+                    p_filter_prevalence or p_filter_abundance:
+                # Filter OTU-table while reading it (by chunks of rows)
+                tab = do_filter_tsv(i_table, metadata, p_filter_prevalence,
+                                    p_filter_abundance, p_filter_order,
+                                    p_column, p_column_value, p_column_quant,
+                                    p_filter_mode, p_filter_expr)
+                message = 'filtered'
+            else:
+                tab = read_table(i_table)
 
         o_few = '%s/TOO_FEW.%sf.skip' % (dirname(o_html), tab.shape[0])
         if tab.shape[0] < 10:
@@ -84,88 +149,128 @@ def xphate(
                 pass
             sys.exit(0)
 
-        tab_norm = pd.DataFrame(
-            normalize(tab, norm='l1', axis=0),
-            index=tab.index, columns=tab.columns).T
-        o_few = '%s/TOO_FEW.%ss.skip' % (dirname(o_html), tab_norm.columns.size)
-        if isfile(o_few) or tab_norm.columns.size <= 50:
-            print('Too few samples to perform PHATE (%s samples)' % tab_norm.columns.size)
+        tab_norm = normalize(get_sparse_matrix(tab).T, norm='l1', axis=1).tocsr()
+        samples = tab.columns.tolist()
+        o_few = '%s/TOO_FEW.%ss.skip' % (dirname(o_html), tab_norm.shape[1])
+        if isfile(o_few) or tab_norm.shape[1] <= 50:
+            print('Too few samples to perform PHATE (%s samples)' % tab_norm.shape[1])
             with open(o_few, 'w'):
                 pass
             sys.exit(0)
 
-        jobs, fpos, fpos_3d = [], [], []
-        for knn in knns:
-            fpo = '%s_tmp-%s.tsv' % (splitext(o_html)[0], knn)
-            fpos.append(fpo)
-            fpo_3d = '%s_tmp-%s_3d.tsv' % (splitext(o_html)[0], knn)
-            fpos_3d.append(fpo_3d)
-            p = mp.Process(
-                target=run_phate,
-                args=(fpo, fpo_3d, tab_norm, knn, decays,
-                      ts, p_jobs, make_3d, verbose,))
-            jobs.append(p)
-            p.start()
-        for j in jobs:
-            j.join()
-
-        full_pds = pd.concat([pd.read_csv(
-            x, header=0, sep='\t', dtype={'sample_name': str}) for x in fpos])
-        full_pds = full_pds.set_index(
-            [x for x in full_pds.columns if 'cluster' not in x]
-        ).stack().reset_index().rename(
-            columns={'level_6': 'variable', 0: 'factor'})
-        fpo = '%s_xphate.tsv' % splitext(o_html)[0]
-        full_pds.to_csv(fpo, index=False, sep='\t')
-        for i in fpos:
-            os.remove(i)
+        scale_params = get_scale_params(
+            tab_norm.shape[0], tab_norm.shape[1], p_n_landmark, p_n_pca,
+            p_mds_solver, p_svd_iter, p_svd_oversamples, auto_scale)
+        if verbose and auto_scale:
+            print('auto-scale: %s' % ', '.join(
+                '%s=%s' % x for x in scale_params.items()))
+
+        # the clustering stage is skipped if the clusters are not shown
+        cluster_ks = []
+        if clusters:
+            cluster_ks = list(range(min(p_cluster_ks), max(p_cluster_ks) + 1))
+        grid = list(itertools.product(knns, decays, ts))
+        entries, missing, cache_paths = {}, [], {}
+        if p_cache_dir:
+            # re-use the grid points already computed on this same table
+            table_hash = get_table_hash(tab_norm, samples)
+            for (knn, decay, t) in grid:
+                cache_paths[(knn, decay, t)] = get_cache_path(
+                    abspath(p_cache_dir), table_hash,
+                    {'knn': knn, 'decay': decay, 't': t,
+                     'share_knn': share_knn, 'cluster_ks': cluster_ks,
+                     'cluster_method': p_cluster_method,
+                     'warm_mds': warm_mds, **scale_params})
+                entry = read_cache(
+                    cache_paths[(knn, decay, t)], make_3d, write_vne)
+                if entry is None:
+                    missing.append((knn, decay, t))
+                else:
+                    entries[(knn, decay, t)] = entry
+            if verbose:
+                print('%s/%s grid points in cache' % (len(entries), len(grid)))
+        else:
+            missing = grid
+
+        # bounded pool over the knn x decay x t grid
+        tasks = get_tasks(missing, p_jobs)
+        if tasks or write_pca:
+            # the PCA that each fit would redo on the same table
+            tab_pca = reduce_data(
+                tab_norm, scale_params['n_pca'], scale_params['svd_iter'],
+                scale_params['svd_oversamples'])
+        if write_pca:
+            if sparse.issparse(tab_pca):
+                print('Warning: no PCA written, the table of %s samples and '
+                      '%s features is not reduced (see --p-n-pca)' %
+                      tab_norm.shape)
+            else:
+                pca_pds = pd.DataFrame(
+                    tab_pca, index=pd.Index(samples, name='sample_name'),
+                    columns=['PC%s' % x for x in range(1, tab_pca.shape[1] + 1)])
+                fpo_pca = '%s_xphate_pca.tsv' % splitext(o_html)[0]
+                pca_pds.to_csv(fpo_pca, sep='\t')
+        if tasks:
+            n_procs = min(max(p_jobs, 1), len(tasks))
+            n_jobs = max(p_jobs // n_procs, 1)
+            args = [(knn, task_decays, task_ts, n_jobs, make_3d, share_knn,
+                     write_vne, cluster_ks, p_cluster_method, warm_mds,
+                     scale_params, verbose)
+                    for (knn, task_decays, task_ts) in tasks]
+            # workers attach to the normalised table instead of getting a copy
+            shms, spec = share_matrix(tab_pca)
+            try:
+                with mp.Pool(n_procs, initializer=init_worker,
+                             initargs=(spec, samples)) as pool:
+                    for task_results in pool.imap_unordered(run_task, args):
+                        for (point, *entry) in task_results:
+                            entries[point] = tuple(entry)
+                            if p_cache_dir:
+                                write_cache(cache_paths[point], tuple(entry))
+            finally:
+                release_matrix(shms)
+        results = [entries[point] for point in grid]
+        if align_mds:
+            # steadier plots from one grid point (slider position) to the next
+            align_embeddings([x[0] for x in results], ['PHATE1', 'PHATE2'])
+            if make_3d:
+                align_embeddings([x[1] for x in results],
+                                 ['PHATE1', 'PHATE2', 'PHATE3'])
+
+        full_pds = pd.concat([x[0] for x in results])
+        write_results(stack_clusters(full_pds),
+                      '%s_xphate' % splitext(o_html)[0], p_res_format)
 
         if make_3d:
-            full_pds_3d = pd.concat([pd.read_csv(
-                x, header=0, sep='\t', dtype={'sample_name': str}) for x in
-                fpos_3d])
-            fpo_3d = '%s_xphate_3d.tsv' % splitext(o_html)[0]
-            full_pds_3d.to_csv(fpo_3d, index=False, sep='\t')
-            for i in fpos_3d:
-                os.remove(i)
-
-    metadata, columns = pd.DataFrame(), []
-    if m_metadata:
-        if verbose:
-            print('Read metadata...', end='')
-        metadata, columns = get_metadata(m_metadata, p_columns)
-        if verbose:
-            print('done.')
+            full_pds_3d = pd.concat([x[1] for x in results])
+            write_results(full_pds_3d, '%s_xphate_3d' % splitext(o_html)[0],
+                          p_res_format)
 
+        if write_vne:
+            vne_pds = pd.concat([x[2] for x in results]).drop_duplicates(
+                ['knn', 'decay', 't'])
+            fpo_vne = '%s_xphate_vne.tsv' % splitext(o_html)[0]
+            vne_pds.to_csv(fpo_vne, index=False, sep='\t')
+
+    if full_pds_3d.shape[0]:
+        # 3D coordinates next to the 2D ones, for the rotatable view
+        full_pds = full_pds.merge(full_pds_3d.rename(
+            columns={'PHATE%s' % x: 'PHATE3D_%s' % x for x in [1, 2, 3]}),
+            on=['knn', 'decay', 't', 'sample_name'], how='left')
+
+    # the metadata is shipped once per sample (not per knn/decay/t point)
+    # and joined to the embeddings in the browser
+    meta_pds = pd.DataFrame()
+    columns = [x for x in (p_columns or []) if x in metadata.columns]
     if metadata.shape[0] and len(columns):
-        if verbose:
-            print('Merge metadata...', end='')
-        metadata = metadata[
-            (['sample_name'] + columns)
-        ].set_index(
-            'sample_name')
-        dtypes = {'NA': 'avoid'}
+        meta_pds = metadata.loc[
+            metadata.index.isin(full_pds['sample_name']), columns].copy()
         for col in columns:
-            dt = str(metadata[col].dtype)
-            if dt == 'object':
-                dtype = 'categorical'
-            else:
-                dtype = 'numerical'
-            dtypes[col] = dtype
-        metadata = metadata.fillna('NA').stack().reset_index().rename(
-            columns={'level_1': 'variable', 0: 'factor'})
-        full_pds_meta = full_pds.drop(
-            columns=['variable', 'factor']
-        ).merge(
-            metadata, on='sample_name', how='left'
-        ).fillna('NA')
-        full_pds_meta['dtype'] = [dtypes[var] for var in full_pds_meta.variable]
-
-        if verbose:
-            print('done.')
-        full_pds['dtype'] = 'categorical'
-        full_pds = pd.concat([full_pds, full_pds_meta], sort=False)
+            if str(meta_pds[col].dtype) == 'object':
+                meta_pds[col] = meta_pds[col].fillna('NA')
+        meta_pds = meta_pds.reset_index()
 
-    make_figure(i_table, i_res, o_html, full_pds, ts,
+    make_figure(i_table, i_res, o_html, full_pds, meta_pds, vne_pds, ts,
                 ts_step, decays, decays_step, knns, knns_step,
-                clusters, separate)
+                clusters, separate, p_html_data, p_max_points, p_num_agg,
+                p_jobs, p_vega_dir)
@@ -13,7 +13,7 @@ classes = """
     License :: OSI Approved :: BSD License
     Topic :: Scientific/Engineering
     Topic :: Scientific/Engineering :: Bio-Informatics
-    Programming Language :: Python :: 3.5
+    Programming Language :: Python :: 3.8
     Programming Language :: Python :: 3 :: Only
     Operating System :: Unix
     Operating System :: POSIX
@@ -52,14 +52,17 @@ setup(
     packages=find_packages(),
     install_requires=[
         "click >= 6.7",
-        'pandas >= 0.19.0',
+        'numpy',
+        'scipy',
+        'pandas >= 0.25.0',
         # 'altair >= 4.1.0',
         'altair == 3.1.0',
-        'scikit-learn',
+        'scikit-learn >= 1.1',
         'phate'
     ],
+    extras_require={'biom': ['h5py'], 'parquet': ['pyarrow']},
     classifiers=classifiers,
     entry_points={'console_scripts': standalone},
     package_data={},
-    python_requires='>=3.6',
+    python_requires='>=3.8',
 )